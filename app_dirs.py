@@ -0,0 +1,19 @@
+import os
+import sys
+from pathlib import Path
+
+APP_NAME = 'coj-maps-downloader'
+
+
+def app_cache_dir() -> Path:
+    if sys.platform == 'win32':
+        base = Path(os.environ.get('LOCALAPPDATA') or Path.home() / 'AppData' / 'Local')
+    else:
+        base = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache')
+    return base / APP_NAME
+
+
+def blob_store_dir() -> Path:
+    if blob_store := os.environ.get('COJ_MAPS_BLOB_STORE'):
+        return Path(blob_store)
+    return app_cache_dir() / 'blobs'
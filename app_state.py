@@ -0,0 +1,24 @@
+import json
+
+from app_dirs import app_cache_dir
+
+STATE_PATH = app_cache_dir() / 'state.json'
+
+
+def load_state() -> dict:
+    try:
+        with STATE_PATH.open('r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return state if isinstance(state, dict) else {}
+
+
+def save_state(**values):
+    state = load_state()
+    state.update(values)
+    STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = STATE_PATH.with_name(STATE_PATH.name + '.tmp')
+    with tmp_path.open('w', encoding='utf-8') as f:
+        json.dump(state, f)
+    tmp_path.replace(STATE_PATH)
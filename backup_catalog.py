@@ -0,0 +1,223 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import shutil
+import time
+from pathlib import Path
+
+from hash_cache import HASH_CACHE
+from hashing import HASH_ENGINE
+from utils import sha256_file, rename_file, CHUNK_SIZE
+
+CATALOG_NAME = '.backups.json'
+MAPS_KEEP_VERSIONS = 5
+BACKUP_POLICY = {'keep_versions': MAPS_KEEP_VERSIONS, 'max_bytes': None, 'compress_cold': False}
+
+
+def gzip_file(src: Path, dst: Path):
+    with src.open('rb') as src_f, gzip.open(dst, 'wb', compresslevel=6) as dst_f:
+        shutil.copyfileobj(src_f, dst_f, CHUNK_SIZE)
+
+
+def gunzip_file(src: Path, dst: Path) -> str:
+    h = hashlib.sha256()
+    with gzip.open(src, 'rb') as src_f, dst.open('wb') as dst_f:
+        while chunk := src_f.read(CHUNK_SIZE):
+            h.update(chunk)
+            dst_f.write(chunk)
+    return h.hexdigest()
+
+
+class BackupCatalog:
+    def __init__(self, folder: Path, keep_versions: int | None = None, max_bytes: int | None = None,
+                 compress_cold=False):
+        self.folder = folder
+        self.keep_versions = keep_versions
+        self.max_bytes = max_bytes
+        self.compress_cold = compress_cold
+        self.files: dict[str, dict] | None = None
+        self.load_lock = asyncio.Lock()
+        self.dirty = False
+
+    @property
+    def catalog_path(self) -> Path:
+        return self.folder / CATALOG_NAME
+
+    async def load(self):
+        async with self.load_lock:
+            if self.files is not None:
+                return
+            try:
+                with self.catalog_path.open('r', encoding='utf-8') as f:
+                    self.files = json.load(f)['files']
+            except (OSError, ValueError, KeyError):
+                self.files = {}
+                await self.import_bak_files()
+
+    async def import_bak_files(self):
+        bak_files = [bak_file for bak_file in self.folder.glob('*.bak*') if self.parse_bak_name(bak_file.name)]
+        bak_hashes = await HASH_ENGINE.hash_all(bak_files)
+        for bak_file in sorted(bak_files):
+            name, slot = self.parse_bak_name(bak_file.name)
+            if not (file_hash := bak_hashes[bak_file]):
+                continue
+            entry = self.files.setdefault(name, {'next': 0, 'backups': {}})
+            entry['next'] = max(entry['next'], int(slot or 0) + 1)
+            if file_hash in entry['backups']:
+                bak_file.unlink()
+                continue
+            st = bak_file.stat()
+            entry['backups'][file_hash] = {'slot': bak_file.name, 'size': st.st_size, 'time': st.st_mtime,
+                                           'compressed': False}
+        self.dirty = True
+
+    @staticmethod
+    def parse_bak_name(file_name: str) -> tuple[str, str] | None:
+        name, _, slot = file_name.rpartition('.bak')
+        if not name or (slot and not slot.isdigit()):
+            return None
+        return name, slot
+
+    def slot_name(self, name: str) -> str:
+        entry = self.files.setdefault(name, {'next': 0, 'backups': {}})
+        n = entry['next']
+        entry['next'] += 1
+        return name + '.bak' + (str(n) if n else '')
+
+    async def find(self, name: str, file_hash: str) -> dict | None:
+        await self.load()
+        return self.files.get(name, {}).get('backups', {}).get(file_hash)
+
+    async def versions(self, name: str) -> list[Path]:
+        await self.load()
+        backups = sorted(self.files.get(name, {}).get('backups', {}).values(), key=lambda backup: backup['time'],
+                         reverse=True)
+        return [self.folder / backup['slot'] for backup in backups if not backup['compressed']]
+
+    async def backup(self, path: Path, file_hash: str | None = None):
+        await self.load()
+        if file_hash is None:
+            file_hash = await sha256_file(path)
+        backups = self.files.setdefault(path.name, {'next': 0, 'backups': {}})['backups']
+        if file_hash in backups and (self.folder / backups[file_hash]['slot']).exists():
+            path.unlink()
+            HASH_CACHE.invalidate(path)
+            backups[file_hash]['time'] = time.time()
+        else:
+            backups.pop(file_hash, None)
+            slot = self.slot_name(path.name)
+            size = path.stat().st_size
+            rename_file(path, self.folder / slot)
+            backups[file_hash] = {'slot': slot, 'size': size, 'time': time.time(), 'compressed': False}
+        self.dirty = True
+        await self.prune(path.name)
+
+    async def restore(self, path: Path, file_hash: str, deep=False) -> bool:
+        await self.load()
+        backups = self.files.get(path.name, {}).get('backups', {})
+        # claimed before the first await so a concurrent prune can't remove it mid-restore
+        backup = backups.pop(file_hash, None)
+        if backup is None:
+            return False
+        self.dirty = True
+        bak_path = self.folder / backup['slot']
+        tmp_path = path.with_name(path.name + '.restore')
+        try:
+            if not bak_path.exists():
+                return False
+            if backup['compressed']:
+                if await asyncio.to_thread(gunzip_file, bak_path, tmp_path) != file_hash:
+                    tmp_path.unlink()
+                    return False
+            else:
+                if await sha256_file(bak_path, deep) != file_hash:
+                    return False
+                rename_file(bak_path, tmp_path)
+            if path.exists():
+                await self.backup(path)
+            rename_file(tmp_path, path)
+            if backup['compressed']:
+                bak_path.unlink()
+                HASH_CACHE.set(path, file_hash)
+        except OSError:
+            try:
+                if tmp_path.exists() and not bak_path.exists():
+                    rename_file(tmp_path, bak_path)
+                tmp_path.unlink(missing_ok=True)
+            except OSError:
+                pass
+            if bak_path.exists():
+                backups[file_hash] = backup
+            return False
+        return True
+
+    def remove(self, name: str, file_hash: str):
+        backup = self.files[name]['backups'].pop(file_hash)
+        (self.folder / backup['slot']).unlink(missing_ok=True)
+        HASH_CACHE.invalidate(self.folder / backup['slot'])
+        self.dirty = True
+
+    async def prune(self, name: str):
+        backups = self.files[name]['backups']
+        by_age = sorted(backups.items(), key=lambda item: item[1]['time'], reverse=True)
+        for n, (file_hash, backup) in enumerate(by_age):
+            if self.keep_versions is not None and n >= self.keep_versions:
+                self.remove(name, file_hash)
+            elif self.compress_cold and n > 0 and not backup['compressed']:
+                bak_path = self.folder / backup['slot']
+                gz_path = bak_path.with_name(bak_path.name + '.gz')
+                await asyncio.to_thread(gzip_file, bak_path, gz_path)
+                bak_path.unlink()
+                HASH_CACHE.invalidate(bak_path)
+                backup.update(slot=gz_path.name, size=gz_path.stat().st_size, compressed=True)
+                self.dirty = True
+        if self.max_bytes is not None:
+            self.cap_size()
+
+    def cap_size(self):
+        by_age = sorted(((backup['time'], name, file_hash, backup['size']) for name, entry in self.files.items()
+                         for file_hash, backup in entry['backups'].items()), reverse=True)
+        total = 0
+        for _, name, file_hash, size in by_age:
+            total += size
+            if total > self.max_bytes:
+                self.remove(name, file_hash)
+
+    def save(self):
+        if not self.dirty or self.files is None:
+            return
+        tmp_path = self.catalog_path.with_name(CATALOG_NAME + '.tmp')
+        with tmp_path.open('w', encoding='utf-8') as f:
+            json.dump({'version': 1, 'files': self.files}, f, indent=1)
+        tmp_path.replace(self.catalog_path)
+        self.dirty = False
+
+
+CATALOGS: dict[Path, BackupCatalog] = {}
+
+
+def configure_backups(keep_versions: int | None = None, max_bytes: int | None = None,
+                      compress_cold: bool | None = None):
+    if keep_versions is not None:
+        BACKUP_POLICY['keep_versions'] = keep_versions
+    if max_bytes is not None:
+        BACKUP_POLICY['max_bytes'] = max_bytes or None
+    if compress_cold is not None:
+        BACKUP_POLICY['compress_cold'] = compress_cold
+
+
+def get_catalog(folder: Path, maps=False) -> BackupCatalog:
+    folder = folder.absolute()
+    if folder not in CATALOGS:
+        CATALOGS[folder] = BackupCatalog(folder)
+    catalog = CATALOGS[folder]
+    catalog.keep_versions = BACKUP_POLICY['keep_versions'] if maps else None
+    catalog.max_bytes = BACKUP_POLICY['max_bytes']
+    catalog.compress_cold = BACKUP_POLICY['compress_cold']
+    return catalog
+
+
+def save_catalogs():
+    for catalog in CATALOGS.values():
+        catalog.save()
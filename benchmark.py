@@ -0,0 +1,180 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SCENARIOS = ('cold-update', 'warm-check', 'source-switch', 'server-mod-apply')
+SOURCES = ('bench-a', 'bench-b')
+
+
+def peak_rss() -> int | None:
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def child_env(workdir: Path) -> dict[str, str]:
+    env = dict(os.environ)
+    env['XDG_CACHE_HOME'] = str(workdir / 'cache')
+    env['LOCALAPPDATA'] = str(workdir / 'cache')
+    env['COJ_MAPS_BLOB_STORE'] = str(workdir / 'blobs')
+    return env
+
+
+def create_install(install_path: Path, mod_root: Path | None = None):
+    (install_path / 'CoJ2' / 'Data').mkdir(parents=True, exist_ok=True)
+    if mod_root:
+        for steam_file in mod_root.glob('steam_*'):
+            shutil.copyfile(steam_file, install_path / steam_file.name.removeprefix('steam_'))
+
+
+async def run_child_scenario(scenario: str, server_url: str, workdir: Path) -> dict:
+    from http_client import HTTP_CLIENT
+    from map_sync import MapSync
+    from server_mod_installer import ServerModInstaller
+
+    sources = {name: {'manifest': f'{server_url}{name}/manifest.json', 'maps': f'{server_url}{name}/maps/'}
+               for name in SOURCES}
+    install_path = workdir / 'install'
+    start = time.perf_counter()
+    if scenario == 'server-mod-apply':
+        with (workdir / 'srv' / 'mod' / 'releases.json').open('r', encoding='utf-8') as f:
+            releases = json.load(f)
+        mod_install_path = workdir / 'mod_install'
+        success = await ServerModInstaller(mod_install_path, lambda message: None, mod_url=f'{server_url}repos/mod/',
+                                           releases=releases).apply()
+    else:
+        map_sync = MapSync(sources=sources)
+        if scenario == 'warm-check':
+            success = await map_sync.check_maps(install_path, SOURCES[0]) and map_sync.all_ok()
+        elif scenario == 'source-switch':
+            success = await map_sync.update_maps(install_path, SOURCES[1]) and map_sync.all_ok()
+            success = await map_sync.update_maps(install_path, SOURCES[0]) and map_sync.all_ok() and success
+        else:
+            success = await map_sync.update_maps(install_path, SOURCES[0]) and map_sync.all_ok()
+    wall_time = time.perf_counter() - start
+    await HTTP_CLIENT.aclose()
+    return {'success': bool(success), 'wall_time': wall_time, 'peak_rss': peak_rss()}
+
+
+def run_scenario(scenario: str, server, workdir: Path) -> dict:
+    before = server.counters()
+    process = subprocess.run([sys.executable, __file__, '--child', scenario, '--server-url', server.url,
+                              '--workdir', str(workdir)], env=child_env(workdir), capture_output=True, text=True,
+                             cwd=Path(__file__).parent)
+    if process.returncode:
+        return {'scenario': scenario, 'success': False, 'error': process.stderr.strip().splitlines()[-1:]}
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    after = server.counters()
+    for key in after:
+        result[key] = after[key] - before[key]
+    result['throughput'] = result['bytes_sent'] / result['wall_time'] if result['wall_time'] else 0.0
+    result['scenario'] = scenario
+    return result
+
+
+def load_previous(output: Path, params: dict) -> dict | None:
+    if not output.exists():
+        return None
+    previous = None
+    with output.open('r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('params') == params:
+                previous = record
+    return previous
+
+
+def print_results(record: dict, previous: dict | None):
+    previous_results = {result['scenario']: result for result in (previous or {}).get('results', [])}
+    for result in record['results']:
+        if not result.get('success'):
+            print(f'{result["scenario"]:<18} FAILED {result.get("error", "")}')
+            continue
+        line = (f'{result["scenario"]:<18} {result["wall_time"]:8.3f} s  {result["throughput"] / 2 ** 20:8.2f} MiB/s  '
+                f'{result["requests"]:6d} req')
+        if result['peak_rss']:
+            line += f'  {result["peak_rss"] / 2 ** 20:7.1f} MiB rss'
+        if old := previous_results.get(result['scenario']):
+            if old.get('success') and old['wall_time']:
+                line += f'  ({(result["wall_time"] / old["wall_time"] - 1) * 100:+.1f} % time vs previous)'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark check/update/server-mod against a local stand-in server')
+    parser.add_argument('--maps', type=int, default=100, help='synthetic maps per source')
+    parser.add_argument('--map-size', default='1M', help='average map size, e.g. 512K or 20M')
+    parser.add_argument('--latency', type=float, default=0.0, help='injected latency per request in seconds')
+    parser.add_argument('--bandwidth', help='per-connection bandwidth limit, e.g. 10M (bytes/s)')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated subset of scenarios')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', type=Path, help='keep generated data in this folder')
+    parser.add_argument('--output', type=Path, default=Path('bench_results.jsonl'),
+                        help='results are appended to this JSON lines file')
+    parser.add_argument('--child', choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('--server-url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = asyncio.run(run_child_scenario(args.child, args.server_url, args.workdir))
+        print(json.dumps(result))
+        return
+
+    from cli import parse_size
+    from stand_in_server import StandInServer, generate_map_source, generate_server_mod
+
+    scenarios = [scenario for scenario in args.scenarios.split(',') if scenario]
+    if unknown := set(scenarios) - set(SCENARIOS):
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+    params = {'maps': args.maps, 'map_size': parse_size(args.map_size), 'latency': args.latency,
+              'bandwidth': parse_size(args.bandwidth) if args.bandwidth else None,
+              'failure_rate': args.failure_rate, 'seed': args.seed}
+    workdir = args.workdir or Path(tempfile.mkdtemp(prefix='coj_bench_'))
+    try:
+        srv = workdir / 'srv'
+        generate_map_source(srv / SOURCES[0], args.maps, params['map_size'], args.seed)
+        generate_map_source(srv / SOURCES[1], args.maps, params['map_size'], args.seed + 1,
+                            shared_from=srv / SOURCES[0])
+        releases = generate_server_mod(srv / 'mod', args.seed)
+        with (srv / 'mod' / 'releases.json').open('w', encoding='utf-8') as f:
+            json.dump(releases, f)
+        for path in (workdir / 'install', workdir / 'mod_install', workdir / 'cache', workdir / 'blobs'):
+            shutil.rmtree(path, ignore_errors=True)
+        create_install(workdir / 'install')
+        create_install(workdir / 'mod_install', srv / 'mod')
+
+        server = StandInServer(srv, args.latency, params['bandwidth'], args.failure_rate, args.seed)
+        server.start()
+        try:
+            results = [run_scenario(scenario, server, workdir) for scenario in SCENARIOS if scenario in scenarios]
+        finally:
+            server.stop()
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+              'platform': platform.platform(), 'params': params, 'results': results}
+    previous = load_previous(args.output, params)
+    print_results(record, previous)
+    with args.output.open('a', encoding='utf-8') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+if __name__ == '__main__':
+    main()
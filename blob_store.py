@@ -0,0 +1,81 @@
+import asyncio
+import os
+import shutil
+import sys
+from pathlib import Path
+
+from app_dirs import blob_store_dir
+from hash_cache import HASH_CACHE
+from utils import sha256_file
+
+FICLONE = 0x40049409
+
+
+def reflink(src: Path, dst: Path):
+    if not sys.platform.startswith('linux'):
+        raise OSError('reflink not supported')
+    import fcntl
+    with src.open('rb') as src_f, dst.open('wb') as dst_f:
+        try:
+            fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+        except OSError:
+            dst_f.close()
+            dst.unlink(missing_ok=True)
+            raise
+
+
+def link_or_copy(src: Path, dst: Path, copy=True) -> bool:
+    tmp_path = dst.with_name(dst.name + '.tmp')
+    tmp_path.unlink(missing_ok=True)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        try:
+            reflink(src, tmp_path)
+        except OSError:
+            if not copy:
+                return False
+            shutil.copyfile(src, tmp_path)
+    tmp_path.replace(dst)
+    return True
+
+
+async def copy_verified(src: Path, dst: Path, file_hash: str) -> bool:
+    if not src.is_file() or await sha256_file(src) != file_hash:
+        return False
+    await asyncio.to_thread(link_or_copy, src, dst)
+    HASH_CACHE.set(dst, file_hash)
+    return True
+
+
+class BlobStore:
+    def __init__(self, root: Path):
+        self.root = root
+
+    def path_for(self, file_hash: str) -> Path:
+        return self.root / file_hash[:2] / file_hash
+
+    def has(self, file_hash: str) -> bool:
+        return self.path_for(file_hash).is_file()
+
+    async def add(self, path: Path, file_hash: str):
+        blob_path = self.path_for(file_hash)
+        if blob_path.is_file():
+            return
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        if await asyncio.to_thread(link_or_copy, path, blob_path, False):
+            HASH_CACHE.set(blob_path, file_hash)
+
+    async def materialize(self, file_hash: str, path: Path) -> bool:
+        blob_path = self.path_for(file_hash)
+        if not blob_path.is_file():
+            return False
+        if await sha256_file(blob_path) != file_hash:
+            blob_path.unlink()
+            return False
+        await asyncio.to_thread(link_or_copy, blob_path, path)
+        HASH_CACHE.set(path, file_hash)
+        return True
+
+
+BLOB_STORE = BlobStore(blob_store_dir())
@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import io
+import os
+import queue
+import tarfile
+import zlib
+from pathlib import Path
+from typing import Callable
+
+import httpx
+
+from http_client import HTTP_CLIENT
+from scheduler import SCHEDULER
+from tracing import TRACER
+from utils import CHUNK_SIZE
+
+REQUEST_OVERHEAD = 0.3
+DEFAULT_MAP_SIZE = 4 * 1024 * 1024
+DEFAULT_BANDWIDTH = 10 * 1024 * 1024
+QUEUE_CHUNKS = 16
+
+
+def archive_source(source: dict[str, str]) -> tuple[str, str] | None:
+    if 'archive' in source:
+        return source['archive'], source.get('archive_path', '')
+    url = httpx.URL(source['maps'])
+    parts = url.path.strip('/').split('/')
+    if url.host != 'raw.githubusercontent.com' or len(parts) < 3:
+        return None
+    owner, repo, rest = parts[0], parts[1], parts[2:]
+    if rest[:2] == ['refs', 'heads'] and len(rest) > 2:
+        ref, path = '/'.join(rest[:3]), rest[3:]
+    else:
+        ref, path = rest[0], rest[1:]
+    return f'https://codeload.github.com/{owner}/{repo}/tar.gz/{ref}', ''.join(part + '/' for part in path)
+
+
+def prefer_bulk(needed: int, total: int, avg_size: float, bandwidth: float, overhead: float, downloads: int) -> bool:
+    per_file = needed * overhead / max(1, downloads) + needed * avg_size / bandwidth
+    bulk = overhead + total * avg_size / bandwidth
+    return bulk < per_file
+
+
+class QueueReader(io.RawIOBase):
+    def __init__(self, chunks: queue.Queue):
+        self.chunks = chunks
+        self.buffer = b''
+        self.eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self.buffer and not self.eof:
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.eof = True
+            else:
+                self.buffer = chunk
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+
+def extract_entries(reader: io.RawIOBase, archive_path: str, wanted: dict[str, str], maps_path: Path,
+                    entry_func: Callable[[str, bool], None]) -> dict[str, bool]:
+    results = {}
+    try:
+        with tarfile.open(fileobj=io.BufferedReader(reader, CHUNK_SIZE), mode='r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                name = member.name.split('/', 1)[1] if '/' in member.name else member.name
+                if not name.startswith(archive_path):
+                    continue
+                map_file = name[len(archive_path):]
+                if map_file not in wanted or map_file in results:
+                    continue
+                tmp_path = maps_path / (map_file + '.bulk')
+                h = hashlib.sha256()
+                with tar.extractfile(member) as src_f, tmp_path.open('wb') as dst_f:
+                    while chunk := src_f.read(CHUNK_SIZE):
+                        h.update(chunk)
+                        dst_f.write(chunk)
+                    dst_f.flush()
+                    os.fsync(dst_f.fileno())
+                results[map_file] = h.hexdigest() == wanted[map_file]
+                if results[map_file]:
+                    tmp_path.replace(maps_path / map_file)
+                else:
+                    tmp_path.unlink()
+                entry_func(map_file, results[map_file])
+                if len(results) == len(wanted):
+                    break
+    except (tarfile.TarError, EOFError, OSError, zlib.error):
+        pass
+    return results
+
+
+def put_chunk(chunks: queue.Queue, chunk: bytes | None, extractor: asyncio.Future) -> bool:
+    while not extractor.done():
+        try:
+            chunks.put(chunk, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+async def bulk_download(url: str, archive_path: str, wanted: dict[str, str], maps_path: Path,
+                        entry_func: Callable[[str, bool], None] = lambda map_file, ok: None) -> dict[str, bool]:
+    loop = asyncio.get_running_loop()
+    chunks: queue.Queue = queue.Queue(QUEUE_CHUNKS)
+    extractor = loop.run_in_executor(None, extract_entries, QueueReader(chunks), archive_path, wanted, maps_path,
+                                     lambda map_file, ok: loop.call_soon_threadsafe(entry_func, map_file, ok))
+    try:
+        with TRACER.span('bulk_archive', 'bulk', url=url, wanted=len(wanted)):
+            async with HTTP_CLIENT.stream('GET', url, follow_redirects=True) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                    TRACER.count('download_bytes', len(chunk), 'bulk')
+                    await SCHEDULER.transferred(len(chunk))
+                    if not await loop.run_in_executor(None, put_chunk, chunks, chunk, extractor):
+                        break
+    except httpx.HTTPError:
+        pass
+    finally:
+        await loop.run_in_executor(None, put_chunk, chunks, None, extractor)
+    return await extractor
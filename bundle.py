@@ -0,0 +1,263 @@
+import asyncio
+import hashlib
+import json
+import mmap
+import os
+import struct
+import time
+from pathlib import Path
+from typing import Callable
+
+import httpx
+
+from backup_catalog import get_catalog, save_catalogs
+from blob_store import BLOB_STORE
+from constants import CUSTOM_MAP_SOURCES
+from hash_cache import HASH_CACHE
+from hashing import HASH_ENGINE
+from manifest_cache import MANIFEST_CACHE, manifest_hashes
+from map_sync import MapSync, get_maps_path, load_applied, save_applied
+from scheduler import SCHEDULER
+from server_mod_installer import ServerModInstaller, ZIP_CACHE_DIR, zip_matches
+from utils import CHUNK_SIZE, download_to_file, sha256_file
+
+BUNDLE_MAGIC = b'COJBNDL1'
+BUNDLE_VERSION = 1
+HEADER = struct.Struct('<8sQQ')
+ALIGN = 4096
+IMPORTED_STATUSES = ('ok', 'installed')
+
+
+def align(offset: int) -> int:
+    return -(-offset // ALIGN) * ALIGN
+
+
+def read_toc(bundle_path: Path) -> dict:
+    with bundle_path.open('rb') as f:
+        magic, toc_offset, toc_size = HEADER.unpack(f.read(HEADER.size))
+        if magic != BUNDLE_MAGIC:
+            raise ValueError(f'{bundle_path} is not a bundle')
+        f.seek(toc_offset)
+        toc = json.loads(f.read(toc_size))
+    if toc.get('version') != BUNDLE_VERSION:
+        raise ValueError(f'unsupported bundle version {toc.get("version")}')
+    return toc
+
+
+def copy_into(src: Path, bundle_path: Path, offset: int) -> str:
+    h = hashlib.sha256()
+    with src.open('rb') as src_f, bundle_path.open('r+b') as dst_f:
+        dst_f.seek(offset)
+        while chunk := src_f.read(CHUNK_SIZE):
+            h.update(chunk)
+            dst_f.write(chunk)
+    return h.hexdigest()
+
+
+def extract_entry(data: mmap.mmap | None, bundle_path: Path, entry: dict, dst: Path) -> str:
+    h = hashlib.sha256()
+    start, end = entry['offset'], entry['offset'] + entry['size']
+    with dst.open('wb') as dst_f:
+        if data is not None:
+            with memoryview(data) as view:
+                for offset in range(start, end, CHUNK_SIZE):
+                    chunk = view[offset:min(offset + CHUNK_SIZE, end)]
+                    h.update(chunk)
+                    dst_f.write(chunk)
+        else:
+            with bundle_path.open('rb') as src_f:
+                src_f.seek(start)
+                remaining = entry['size']
+                while remaining and (chunk := src_f.read(min(CHUNK_SIZE, remaining))):
+                    h.update(chunk)
+                    dst_f.write(chunk)
+                    remaining -= len(chunk)
+        dst_f.flush()
+        os.fsync(dst_f.fileno())
+    return h.hexdigest()
+
+
+async def resolve_map(url: str, map_hash: str, candidates: list[Path]) -> Path | None:
+    for path in candidates:
+        if path.is_file() and await sha256_file(path) == map_hash:
+            return path
+    blob_path = BLOB_STORE.path_for(map_hash)
+    blob_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        async with SCHEDULER.downloading():
+            if await download_to_file(url, blob_path, map_hash) == map_hash:
+                return blob_path
+    except httpx.HTTPError:
+        pass
+    return None
+
+
+async def export_bundle(bundle_path: Path, coj_path: Path, source_name: str,
+                        log_func: Callable[[str], None] = lambda message: None,
+                        sources: dict[str, dict[str, str]] = CUSTOM_MAP_SOURCES, server_mod=True) -> bool:
+    map_sync = MapSync(log_func, sources=sources)
+    if not await map_sync.fetch_maps(source_name):
+        return False
+    maps_path = get_maps_path(coj_path, lambda message: None)
+    files: dict[tuple[str, str], tuple[Path, str]] = {}
+
+    async def add_map(map_file: str, map_hash: str):
+        candidates = ([maps_path / map_file] if maps_path else []) + [BLOB_STORE.path_for(map_hash)]
+        if path := await resolve_map(sources[source_name]['maps'] + map_file, map_hash, candidates):
+            files['map', map_file] = (path, map_hash)
+        else:
+            log_func(f'{map_file}: not available, left out of the bundle!')
+
+    log_func('collecting maps..')
+    async with asyncio.TaskGroup() as tg:
+        for map_file, map_hash in map_sync.map_dict.items():
+            tg.create_task(add_map(map_file, map_hash))
+    toc = {'version': BUNDLE_VERSION, 'created': int(time.time()), 'source': source_name,
+           'manifest_url': sources[source_name]['manifest'], 'manifest': map_sync.manifest, 'entries': []}
+    if server_mod:
+        installer = ServerModInstaller(coj_path, log_func)
+        release_tag = next(iter(installer.releases))
+        zip_path = ZIP_CACHE_DIR / f'{release_tag}.zip'
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(HASH_ENGINE.executor, zip_matches, zip_path,
+                                          installer.releases[release_tag]):
+            zip_path.unlink(missing_ok=True)
+            if not await installer.download_zip(release_tag, zip_path) or not await loop.run_in_executor(
+                    HASH_ENGINE.executor, zip_matches, zip_path, installer.releases[release_tag]):
+                log_func('server list mod not available, left out of the bundle!')
+                zip_path = None
+        if zip_path:
+            files['server_mod', zip_path.name] = (zip_path, await sha256_file(zip_path))
+            toc['server_mod'] = {'release': release_tag, 'releases': installer.releases}
+    offset = align(HEADER.size)
+    for (kind, name), (path, file_hash) in sorted(files.items()):
+        size = path.stat().st_size
+        toc['entries'].append({'kind': kind, 'name': name, 'offset': offset, 'size': size, 'sha256': file_hash})
+        offset = align(offset + size)
+    tmp_path = bundle_path.with_name(bundle_path.name + '.tmp')
+    with tmp_path.open('wb') as f:
+        f.truncate(offset)
+    log_func(f'writing {len(toc["entries"])} files to {bundle_path}..')
+    loop = asyncio.get_running_loop()
+    hashes = await asyncio.gather(*(loop.run_in_executor(HASH_ENGINE.executor, copy_into,
+                                                         files[entry['kind'], entry['name']][0], tmp_path,
+                                                         entry['offset']) for entry in toc['entries']))
+    if changed := [entry['name'] for entry, file_hash in zip(toc['entries'], hashes) if file_hash != entry['sha256']]:
+        tmp_path.unlink()
+        log_func(f'files changed while exporting: {", ".join(changed)}!')
+        return False
+    toc_bytes = json.dumps(toc).encode()
+    with tmp_path.open('r+b') as f:
+        f.seek(offset)
+        f.write(toc_bytes)
+        f.seek(0)
+        f.write(HEADER.pack(BUNDLE_MAGIC, offset, len(toc_bytes)))
+        f.flush()
+        os.fsync(f.fileno())
+    tmp_path.replace(bundle_path)
+    log_func('bundle written!')
+    return True
+
+
+async def import_bundle(bundle_path: Path, coj_path: Path, log_func: Callable[[str], None] = lambda message: None,
+                        status_func: Callable[[str, str], None] = lambda name, status: None,
+                        sources: dict[str, dict[str, str]] = CUSTOM_MAP_SOURCES) -> dict[str, str] | None:
+    try:
+        toc = read_toc(bundle_path)
+        map_dict = manifest_hashes(toc['manifest'])
+    except (OSError, ValueError, KeyError, struct.error) as e:
+        log_func(str(e))
+        return None
+    maps_path = get_maps_path(coj_path, log_func, create=True)
+    if not maps_path:
+        return None
+    source_name = toc['source']
+    manifest_url = sources[source_name]['manifest'] if source_name in sources else toc['manifest_url']
+    MANIFEST_CACHE.store(manifest_url, {'url': manifest_url, 'etag': None, 'last_modified': None,
+                                        'manifest': toc['manifest']})
+    entries = {entry['name']: entry for entry in toc['entries'] if entry['kind'] == 'map'}
+    results = {}
+
+    def set_status(name: str, status: str):
+        results[name] = status
+        status_func(name, status)
+
+    for map_file in map_dict:
+        if map_file not in entries or entries[map_file]['sha256'] != map_dict[map_file]:
+            set_status(map_file, 'missing in bundle')
+    targets = {maps_path / map_file: entry for map_file, entry in entries.items() if map_file in map_dict
+               and entry['sha256'] == map_dict[map_file]}
+    pending = []
+    log_func('checking maps..')
+    async for map_file_path, file_hash in HASH_ENGINE.hash_batch(targets):
+        if file_hash == targets[map_file_path]['sha256']:
+            set_status(map_file_path.name, 'ok')
+        else:
+            pending.append(map_file_path)
+    catalog = get_catalog(maps_path, maps=True)
+    loop = asyncio.get_running_loop()
+    with bundle_path.open('rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            data = None
+
+        async def install(map_file_path: Path):
+            entry = targets[map_file_path]
+            tmp_path = map_file_path.with_name(map_file_path.name + '.bundle')
+            try:
+                file_hash = await loop.run_in_executor(HASH_ENGINE.executor, extract_entry, data, bundle_path, entry,
+                                                       tmp_path)
+            except OSError as e:
+                tmp_path.unlink(missing_ok=True)
+                set_status(map_file_path.name, f'install failed: {e}')
+                return
+            if file_hash != entry['sha256']:
+                tmp_path.unlink()
+                set_status(map_file_path.name, 'bundle mismatch')
+                return
+            if map_file_path.exists():
+                await catalog.backup(map_file_path)
+            tmp_path.replace(map_file_path)
+            HASH_CACHE.set(map_file_path, file_hash)
+            await BLOB_STORE.add(map_file_path, file_hash)
+            set_status(map_file_path.name, 'installed')
+
+        try:
+            if pending:
+                log_func(f'installing {len(pending)} maps from {bundle_path}..')
+            async with asyncio.TaskGroup() as tg:
+                for map_file_path in pending:
+                    tg.create_task(install(map_file_path))
+            if 'server_mod' in toc:
+                await import_server_mod(toc, data, bundle_path, coj_path, log_func)
+        finally:
+            if data is not None:
+                data.close()
+            HASH_CACHE.save()
+            save_catalogs()
+            applied = {map_file: map_hash for map_file, map_hash in load_applied(maps_path).items()
+                       if map_file not in map_dict}
+            applied.update({map_file: map_hash for map_file, map_hash in map_dict.items()
+                            if results.get(map_file) in IMPORTED_STATUSES})
+            save_applied(maps_path, source_name, applied)
+    return results
+
+
+async def import_server_mod(toc: dict, data: mmap.mmap | None, bundle_path: Path, coj_path: Path,
+                            log_func: Callable[[str], None]):
+    release_tag = toc['server_mod']['release']
+    installer = ServerModInstaller(coj_path, log_func, releases=toc['server_mod']['releases'])
+    if await installer.detect_release() == release_tag:
+        log_func('server list mod already installed.')
+        return
+    entry = next(entry for entry in toc['entries'] if entry['kind'] == 'server_mod')
+    zip_path = ZIP_CACHE_DIR / f'{release_tag}.zip'
+    ZIP_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    loop = asyncio.get_running_loop()
+    if await loop.run_in_executor(HASH_ENGINE.executor, extract_entry, data, bundle_path, entry,
+                                  zip_path) != entry['sha256']:
+        zip_path.unlink()
+        log_func('server list mod in bundle is broken!')
+        return
+    await installer.apply()
@@ -0,0 +1,379 @@
+import asyncio
+import hashlib
+import json
+import re
+import socket
+import time
+from pathlib import Path
+from typing import Awaitable, Callable
+from urllib.parse import unquote
+
+import httpx
+
+from app_dirs import app_cache_dir
+from blob_store import BLOB_STORE
+from constants import CUSTOM_MAP_SOURCES, SERVER_LIST_MOD, SERVER_LIST_MOD_URL
+from delta import BLOCK_INDEX_SUFFIX
+from hash_cache import HASH_CACHE
+from hashing import HASH_ENGINE
+from http_client import HTTP_CLIENT
+from manifest_cache import MANIFEST_CACHE, manifest_hashes
+from server_mod_installer import RELEASE_CACHE, ZIP_CACHE_DIR, zip_matches
+from tracing import TRACER
+from utils import download_to_file, sha256_file
+
+DEFAULT_PORT = 47810
+ANNOUNCE_PORT = 47811
+DISCOVERY_MAGIC = b'coj-maps-cache?'
+DISCOVERY_TIMEOUT = 1.0
+MANIFEST_TTL = 60.0
+RELEASE_TAG = re.compile(r'[\w.-]+')
+BLOCK_INDEX_DIR = app_cache_dir() / 'block_indexes'
+REASONS = {200: 'OK', 206: 'Partial Content', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 416: 'Range Not Satisfiable', 502: 'Bad Gateway'}
+
+
+def cache_sources(base_url: str, sources: dict[str, dict[str, str]] = CUSTOM_MAP_SOURCES) -> dict[str, dict[str, str]]:
+    return {name: {'manifest': f'{base_url}{name}/manifest.json', 'maps': f'{base_url}{name}/maps/'}
+            for name in sources}
+
+
+def cache_mod_url(base_url: str) -> str:
+    return base_url + 'mod/'
+
+
+class CacheError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, port: int):
+        self.port = port
+        self.transport: asyncio.DatagramTransport | None = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        if data == DISCOVERY_MAGIC:
+            self.transport.sendto(json.dumps({'port': self.port}).encode(), addr)
+
+
+class ReplyProtocol(asyncio.DatagramProtocol):
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+
+    def datagram_received(self, data: bytes, addr):
+        try:
+            port = int(json.loads(data)['port'])
+        except (ValueError, KeyError, TypeError):
+            return
+        if not self.future.done():
+            self.future.set_result(f'http://{addr[0]}:{port}/')
+
+
+async def discover_cache(timeout=DISCOVERY_TIMEOUT, targets=('255.255.255.255',)) -> str | None:
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    transport, _ = await loop.create_datagram_endpoint(lambda: ReplyProtocol(future), local_addr=('0.0.0.0', 0),
+                                                       family=socket.AF_INET, allow_broadcast=True)
+    try:
+        for target in targets:
+            transport.sendto(DISCOVERY_MAGIC, (target, ANNOUNCE_PORT))
+        async with asyncio.timeout(timeout):
+            return await future
+    except (TimeoutError, OSError):
+        return None
+    finally:
+        transport.close()
+
+
+class CacheServer:
+    def __init__(self, sources: dict[str, dict[str, str]] = CUSTOM_MAP_SOURCES, mod_url=SERVER_LIST_MOD_URL,
+                 releases: dict[str, dict[str, str]] = SERVER_LIST_MOD, log_func: Callable[[str], None] = print):
+        self.sources = sources
+        self.mod_url = mod_url
+        self.releases = releases
+        self.log_func = log_func
+        self.inflight: dict[str, asyncio.Task] = {}
+        self.manifests: dict[str, tuple[float, dict, dict[str, str]]] = {}
+        self.server: asyncio.Server | None = None
+        self.discovery: asyncio.DatagramTransport | None = None
+
+    async def start(self, host='0.0.0.0', port=DEFAULT_PORT, announce=True) -> int:
+        self.server = await asyncio.start_server(self.handle, host, port)
+        port = self.server.sockets[0].getsockname()[1]
+        if announce:
+            try:
+                self.discovery, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                    lambda: DiscoveryProtocol(port), local_addr=(host, ANNOUNCE_PORT), family=socket.AF_INET,
+                    allow_broadcast=True)
+            except OSError as e:
+                self.log_func(f'LAN announce disabled: {e}')
+        return port
+
+    async def stop(self):
+        if self.discovery is not None:
+            self.discovery.close()
+            self.discovery = None
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        HASH_CACHE.save()
+
+    async def once(self, key: str, factory: Callable[[], Awaitable]):
+        if key not in self.inflight:
+            TRACER.count('cache_upstream_fetches', 1)
+            task = asyncio.ensure_future(factory())
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        else:
+            TRACER.count('cache_deduped_requests', 1)
+        return await asyncio.shield(self.inflight[key])
+
+    async def manifest(self, source_name: str) -> dict:
+        fetched = self.manifests.get(source_name)
+        if fetched and time.monotonic() - fetched[0] < MANIFEST_TTL:
+            return fetched[1]
+        url = self.sources[source_name]['manifest']
+        try:
+            manifest = await self.once('manifest:' + url, lambda: MANIFEST_CACHE.fetch(url))
+        except (httpx.HTTPError, ValueError) as e:
+            cached = MANIFEST_CACHE.load(url)
+            if not cached:
+                raise CacheError(502, f'{url}: {e}')
+            manifest = cached['manifest']
+        try:
+            self.manifests[source_name] = (time.monotonic(), manifest, manifest_hashes(manifest))
+        except ValueError as e:
+            raise CacheError(502, f'{url}: {e}')
+        return manifest
+
+    async def map_hash(self, source_name: str, map_file: str) -> str:
+        await self.manifest(source_name)
+        map_hash = self.manifests[source_name][2].get(map_file)
+        if map_hash is None:
+            raise CacheError(404, f'{map_file} not in manifest')
+        return map_hash
+
+    async def map_blob(self, source_name: str, map_file: str) -> tuple[Path, str]:
+        map_hash = await self.map_hash(source_name, map_file)
+        blob_path = BLOB_STORE.path_for(map_hash)
+        if blob_path.is_file() and await sha256_file(blob_path) == map_hash:
+            TRACER.count('cache_hits', 1)
+            return blob_path, map_hash
+        await self.once('map:' + map_hash, lambda: self.fetch_map(self.sources[source_name]['maps'] + map_file,
+                                                                  map_hash))
+        return blob_path, map_hash
+
+    async def fetch_map(self, url: str, map_hash: str):
+        blob_path = BLOB_STORE.path_for(map_hash)
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        self.log_func(f'fetching {url}..')
+        try:
+            file_hash = await download_to_file(url, blob_path, map_hash, trace_key='cache')
+        except httpx.HTTPError as e:
+            raise CacheError(502, f'{url}: {e}')
+        if file_hash != map_hash:
+            raise CacheError(502, f'{url}: hash mismatch')
+
+    async def block_index(self, source_name: str, map_file: str) -> Path:
+        map_hash = await self.map_hash(source_name, map_file)
+        index_path = BLOCK_INDEX_DIR / (map_hash + BLOCK_INDEX_SUFFIX)
+        if not index_path.is_file():
+            await self.once('index:' + map_hash, lambda: self.fetch_block_index(
+                self.sources[source_name]['maps'] + map_file + BLOCK_INDEX_SUFFIX, map_hash, index_path))
+        return index_path
+
+    @staticmethod
+    async def fetch_block_index(url: str, map_hash: str, index_path: Path):
+        try:
+            response = await HTTP_CLIENT.get(url)
+            response.raise_for_status()
+            index = response.json()
+        except (httpx.HTTPError, ValueError):
+            raise CacheError(404, f'{url}: no block index')
+        if index.get('sha256') != map_hash:
+            raise CacheError(404, f'{url}: stale block index')
+        BLOCK_INDEX_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = index_path.with_name(index_path.name + '.tmp')
+        tmp_path.write_bytes(response.content)
+        tmp_path.replace(index_path)
+
+    async def upstream_release(self, path: str) -> dict:
+        url = self.mod_url + path
+        try:
+            return await self.once('release:' + url, lambda: RELEASE_CACHE.fetch(url))
+        except httpx.HTTPError as e:
+            cached = RELEASE_CACHE.load(url)
+            if not cached:
+                raise CacheError(502, f'{url}: {e}')
+            return cached['manifest']
+
+    async def release(self, path: str, base_url: str) -> dict:
+        release = dict(await self.upstream_release(path))
+        release['assets'] = [dict(asset, browser_download_url=f'{base_url}mod/assets/{release["tag_name"]}.zip')
+                             for asset in release.get('assets', ())
+                             if asset.get('content_type') == 'application/x-zip-compressed'][:1]
+        return release
+
+    def check_tag(self, release_tag: str):
+        if release_tag not in self.releases and (not RELEASE_TAG.fullmatch(release_tag) or release_tag in ('.', '..')):
+            raise CacheError(404, f'{release_tag}: unknown release')
+
+    async def release_zip(self, release_tag: str) -> Path:
+        self.check_tag(release_tag)
+        zip_path = ZIP_CACHE_DIR / f'{release_tag}.zip'
+        if not zip_path.is_file():
+            await self.once('zip:' + release_tag, lambda: self.fetch_release_zip(release_tag, zip_path))
+        return zip_path
+
+    async def fetch_release_zip(self, release_tag: str, zip_path: Path):
+        release = await self.upstream_release('releases/tags/' + release_tag)
+        for asset in release.get('assets', ()):
+            if asset.get('content_type') == 'application/x-zip-compressed':
+                url = asset['browser_download_url']
+                break
+        else:
+            raise CacheError(404, f'{release_tag}: no zip found')
+        ZIP_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = zip_path.with_name(zip_path.name + '.download')
+        self.log_func(f'fetching {url}..')
+        try:
+            await download_to_file(url, tmp_path, follow_redirects=True, trace_key='cache')
+        except httpx.HTTPError as e:
+            raise CacheError(502, f'{url}: {e}')
+        if release_tag in self.releases and not await asyncio.get_running_loop().run_in_executor(
+                HASH_ENGINE.executor, zip_matches, tmp_path, self.releases[release_tag]):
+            tmp_path.unlink(missing_ok=True)
+            raise CacheError(502, f'{url}: files don\'t match the known release hashes')
+        tmp_path.replace(zip_path)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while request_line := await reader.readline():
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                host = headers.get('host') or '{}:{}'.format(*writer.get_extra_info('sockname')[:2])
+                await self.respond(method, unquote(target.split('?', 1)[0]), headers, f'http://{host}/', writer)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (OSError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, method: str, path: str, headers: dict[str, str], base_url: str,
+                      writer: asyncio.StreamWriter):
+        if method not in ('GET', 'HEAD'):
+            await self.send(writer, method, 405, b'')
+            return
+        try:
+            await self.route(method, path, headers, base_url, writer)
+        except CacheError as e:
+            self.log_func(str(e))
+            await self.send(writer, method, e.status, str(e).encode(), {'Content-Type': 'text/plain'})
+
+    async def route(self, method: str, path: str, headers: dict[str, str], base_url: str,
+                    writer: asyncio.StreamWriter):
+        if path == '/':
+            await self.send_json(writer, method, headers, {'sources': list(self.sources), 'mod': self.mod_url})
+            return
+        if path == '/mod/releases/latest' or path.startswith('/mod/releases/tags/'):
+            if path != '/mod/releases/latest':
+                self.check_tag(path.removeprefix('/mod/releases/tags/'))
+            await self.send_json(writer, method, headers,
+                                 await self.release(path.removeprefix('/mod/'), base_url))
+            return
+        if path.startswith('/mod/assets/') and path.endswith('.zip'):
+            zip_path = await self.release_zip(path.removeprefix('/mod/assets/').removesuffix('.zip'))
+            await self.send_file(writer, method, headers, zip_path, 'application/x-zip-compressed')
+            return
+        for source_name in self.sources:
+            prefix = f'/{source_name}/'
+            if not path.startswith(prefix):
+                continue
+            rest = path.removeprefix(prefix)
+            if rest == 'manifest.json':
+                await self.send_json(writer, method, headers, await self.manifest(source_name))
+                return
+            if rest.startswith('maps/') and '/' not in (map_file := rest.removeprefix('maps/')):
+                if map_file.endswith(BLOCK_INDEX_SUFFIX):
+                    index_path = await self.block_index(source_name, map_file.removesuffix(BLOCK_INDEX_SUFFIX))
+                    await self.send_file(writer, method, headers, index_path, 'application/json')
+                else:
+                    blob_path, map_hash = await self.map_blob(source_name, map_file)
+                    await self.send_file(writer, method, headers, blob_path, 'application/octet-stream',
+                                         f'"{map_hash}"')
+                return
+        raise CacheError(404, f'{path} not found')
+
+    @staticmethod
+    def write_head(writer: asyncio.StreamWriter, status: int, length: int, headers: dict[str, str] | None = None):
+        lines = [f'HTTP/1.1 {status} {REASONS.get(status, "")}', f'Content-Length: {length}']
+        lines += [f'{name}: {value}' for name, value in (headers or {}).items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    async def send(self, writer: asyncio.StreamWriter, method: str, status: int, body: bytes,
+                   headers: dict[str, str] | None = None):
+        self.write_head(writer, status, len(body), headers)
+        if method != 'HEAD':
+            writer.write(body)
+        await writer.drain()
+
+    async def send_json(self, writer: asyncio.StreamWriter, method: str, headers: dict[str, str], payload: dict):
+        body = json.dumps(payload).encode()
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        if headers.get('if-none-match') == etag:
+            await self.send(writer, method, 304, b'', {'ETag': etag})
+            return
+        await self.send(writer, method, 200, body, {'ETag': etag, 'Content-Type': 'application/json'})
+
+    async def send_file(self, writer: asyncio.StreamWriter, method: str, headers: dict[str, str], path: Path,
+                        content_type: str, etag: str | None = None):
+        with path.open('rb') as f:
+            size = path.stat().st_size
+            etag = etag or f'"{size:x}-{path.stat().st_mtime_ns:x}"'
+            if headers.get('if-none-match') == etag:
+                await self.send(writer, method, 304, b'', {'ETag': etag})
+                return
+            start, end = 0, size - 1
+            range_header = headers.get('range', '')
+            partial = range_header.startswith('bytes=') and ',' not in range_header and \
+                headers.get('if-range', etag) == etag
+            if partial:
+                first, _, last = range_header.removeprefix('bytes=').partition('-')
+                try:
+                    start = int(first) if first else max(0, size - int(last))
+                    end = min(int(last), end) if first and last else end
+                except ValueError:
+                    partial = False
+                    start, end = 0, size - 1
+                if partial and start > end:
+                    await self.send(writer, method, 416, b'', {'Content-Range': f'bytes */{size}'})
+                    return
+            response_headers = {'ETag': etag, 'Accept-Ranges': 'bytes', 'Content-Type': content_type}
+            if partial:
+                response_headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+            self.write_head(writer, 206 if partial else 200, end - start + 1 if size else 0, response_headers)
+            await writer.drain()
+            if method != 'HEAD' and size:
+                await asyncio.get_running_loop().sendfile(writer.transport, f, start, end - start + 1)
+                TRACER.count('cache_served_bytes', end - start + 1)
+
+
+async def serve(host='0.0.0.0', port=DEFAULT_PORT, announce=True, log_func: Callable[[str], None] = print):
+    server = CacheServer(log_func=log_func)
+    port = await server.start(host, port, announce)
+    log_func(f'serving map-sources and server list mod on http://{host}:{port}/'
+             + (f' (LAN announce on udp/{ANNOUNCE_PORT})' if server.discovery else ''))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
@@ -0,0 +1,270 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import sys
+from pathlib import Path
+
+from backup_catalog import configure_backups, MAPS_KEEP_VERSIONS
+from bundle import export_bundle, import_bundle, IMPORTED_STATUSES
+from cache_server import cache_mod_url, cache_sources, discover_cache, serve, DEFAULT_PORT
+from constants import CUSTOM_MAP_SOURCES, SERVER_LIST_MOD_URL
+from fleet import FleetSync, find_installs
+from fs_watcher import FileWatcher
+from hash_cache import HASH_CACHE
+from hashing import HASH_ENGINE
+from http_client import HTTP_CLIENT
+from install_discovery import cached_start_folder
+from map_sync import MapSync, PROGRESS_STATUSES, get_maps_path
+from scheduler import SCHEDULER
+from server_mod_installer import ServerModInstaller
+from tracing import TRACER
+
+EXIT_OK = 0
+EXIT_NOT_OK = 1
+EXIT_ERROR = 2
+
+
+def log(message: str):
+    print(message, file=sys.stderr)
+
+
+def parse_size(value: str) -> int:
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper().removesuffix('B').removesuffix('I')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='coj_maps_downloader',
+                                     description='CoJ:BiB custom maps downloader + server list mod patcher. '
+                                                 'Starts the GUI when no command is given.')
+    parser.add_argument('--folder', action='append',
+                        help='game or dedicated server folder, may be repeated or a glob pattern to sync a whole '
+                             'fleet of installs (default: auto-detect)')
+    parser.add_argument('--json', action='store_true', help='print the result as JSON on stdout')
+    parser.add_argument('--deep', action='store_true', help='re-hash every file instead of trusting the hash cache')
+    parser.add_argument('--delta', action='store_true',
+                        help='fetch only changed blocks of updated maps when the map-source publishes block indexes')
+    parser.add_argument('--bulk', choices=('auto', 'always', 'never'), default='auto',
+                        help='fetch missing maps as one archive of the map-source repository: when cheaper than '
+                             'single downloads (auto), whenever maps are missing (always) or never')
+    parser.add_argument('--cache', metavar='URL',
+                        help='fetch maps and the server list mod through a LAN cache server, "auto" to find one')
+    parser.add_argument('--downloads', type=int, help='initial number of parallel downloads (tuned automatically)')
+    parser.add_argument('--max-downloads', type=int, help='upper bound for parallel downloads')
+    parser.add_argument('--hash-workers', type=int, help='number of files hashed in parallel')
+    parser.add_argument('--bandwidth-limit', type=parse_size, help='global download limit in bytes/s, e.g. 5M')
+    parser.add_argument('--keep-backups', type=int,
+                        help=f'backed up versions kept per map (default: {MAPS_KEEP_VERSIONS})')
+    parser.add_argument('--backup-limit', type=parse_size,
+                        help='total size of the backups kept per folder, oldest go first, e.g. 2G (default: unlimited)')
+    parser.add_argument('--compress-backups', action='store_true',
+                        help='gzip all but the newest backup of each file')
+    parser.add_argument('--trace', type=Path, help='write a Chrome trace (chrome://tracing, Perfetto) to this file')
+    parser.add_argument('--metrics', type=Path,
+                        help='write summary metrics to this file, Prometheus text for *.prom/*.txt, JSON otherwise')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command, help_text in (('check', 'check installed maps'), ('update', 'download missing or changed maps'),
+                               ('prune', 'back up and remove maps no longer listed by the map-source'),
+                               ('watch', 'check installed maps, then re-verify maps and server list mod files as '
+                                         'they change until interrupted')):
+        subparser = subparsers.add_parser(command, help=help_text)
+        subparser.add_argument('--source', choices=CUSTOM_MAP_SOURCES, default=next(iter(CUSTOM_MAP_SOURCES)))
+    subparser = subparsers.add_parser('switch-source', help='switch installed maps to another map-source')
+    subparser.add_argument('source', choices=CUSTOM_MAP_SOURCES)
+    subparsers.add_parser('server-mod', help='apply or revert the server list mod')
+    subparser = subparsers.add_parser('export', help='pack the manifest and maps of a map-source and the server list '
+                                                     'mod into one bundle file for offline installs')
+    subparser.add_argument('bundle', type=Path)
+    subparser.add_argument('--source', choices=CUSTOM_MAP_SOURCES, default=next(iter(CUSTOM_MAP_SOURCES)))
+    subparser.add_argument('--no-server-mod', action='store_true', help='leave the server list mod out')
+    subparser = subparsers.add_parser('import', help='install maps and the server list mod from a bundle without '
+                                                     'network access')
+    subparser.add_argument('bundle', type=Path)
+    subparser = subparsers.add_parser('cache-server', help='serve all map-sources and the server list mod to the LAN '
+                                                           'from a local cache until interrupted')
+    subparser.add_argument('--host', default='0.0.0.0')
+    subparser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    subparser.add_argument('--no-announce', action='store_true', help="don't answer LAN discovery requests")
+    return parser.parse_args(argv)
+
+
+async def run_maps(args: argparse.Namespace, coj_path: Path) -> tuple[int, dict]:
+    map_sync = MapSync(log, delta=args.delta, bulk=args.bulk, sources=args.sources)
+
+    def status_func(i: int, status: str):
+        if not args.json and status not in PROGRESS_STATUSES:
+            print(f'{map_sync.map_files[i]}: {status}')
+
+    map_sync.status_func = status_func
+    if args.command == 'prune':
+        pruned = await map_sync.prune_orphans(coj_path, args.source)
+        return (EXIT_ERROR if pruned is None else EXIT_OK), {'source': args.source, 'pruned': pruned or []}
+    if args.command == 'check':
+        success = await map_sync.check_maps(coj_path, args.source, args.deep)
+    else:
+        success = await map_sync.update_maps(coj_path, args.source, args.deep)
+    result = {'source': args.source, 'maps': map_sync.results(), 'orphans': map_sync.orphans}
+    if not success:
+        return EXIT_ERROR, result
+    return (EXIT_OK if map_sync.all_ok() else EXIT_NOT_OK), result
+
+
+async def run_fleet(args: argparse.Namespace, coj_paths: list[Path]) -> tuple[int, dict]:
+    def status_func(coj_path: Path, map_file: str, status: str):
+        if not args.json and status not in PROGRESS_STATUSES:
+            print(f'{coj_path}: {map_file}: {status}')
+
+    fleet_sync = FleetSync(coj_paths, log, status_func, delta=args.delta, bulk=args.bulk,
+                           sources=args.sources)
+    success = await fleet_sync.sync_maps(args.source, download=args.command != 'check', deep=args.deep)
+    result = {'source': args.source, 'installs': fleet_sync.report()}
+    if not success:
+        return EXIT_ERROR, result
+    return (EXIT_OK if all(install['ok'] for install in result['installs'].values()) else EXIT_NOT_OK), result
+
+
+async def run_server_mod(args: argparse.Namespace, coj_path: Path) -> tuple[int, dict]:
+    messages = []
+
+    def log_func(message: str):
+        messages.append(message)
+        log(message)
+
+    success = await ServerModInstaller(coj_path, log_func, deep=args.deep, mod_url=args.mod_url).apply()
+    return (EXIT_OK if success else EXIT_ERROR), {'messages': messages}
+
+
+async def run_export(args: argparse.Namespace, coj_path: Path) -> tuple[int, dict]:
+    success = await export_bundle(args.bundle, coj_path, args.source, log, args.sources, not args.no_server_mod)
+    return (EXIT_OK if success else EXIT_ERROR), {'bundle': str(args.bundle), 'source': args.source}
+
+
+async def run_import(args: argparse.Namespace, coj_path: Path) -> tuple[int, dict]:
+    def status_func(map_file: str, status: str):
+        if not args.json:
+            print(f'{map_file}: {status}')
+
+    results = await import_bundle(args.bundle, coj_path, log, status_func, args.sources)
+    if results is None:
+        return EXIT_ERROR, {'bundle': str(args.bundle)}
+    exit_code = EXIT_OK if all(status in IMPORTED_STATUSES for status in results.values()) else EXIT_NOT_OK
+    return exit_code, {'bundle': str(args.bundle), 'maps': results}
+
+
+async def watch_install(args: argparse.Namespace, coj_path: Path):
+    map_sync = MapSync(lambda message: log(f'{coj_path}: {message}'), sources=args.sources)
+
+    def status_func(i: int, status: str):
+        if status not in PROGRESS_STATUSES:
+            print(f'{coj_path}: {map_sync.map_files[i]}: {status}')
+
+    map_sync.status_func = status_func
+    if not await map_sync.check_maps(coj_path, args.source, args.deep):
+        return
+    maps_path = get_maps_path(coj_path, log)
+    installer = ServerModInstaller(coj_path, log, mod_url=args.mod_url)
+    mod_files = {file_name for release in installer.releases.values() for file_name in release}
+    changes: asyncio.Queue[set[Path]] = asyncio.Queue()
+    watcher = FileWatcher([coj_path] + ([maps_path] if maps_path.exists() else []), changes.put_nowait)
+    watcher.start()
+    log(f'{coj_path}: watching for changes ({watcher.mode})..')
+    try:
+        while True:
+            paths = await changes.get()
+            await map_sync.verify_changed(maps_path, paths)
+            if changed := {path.name for path in paths if path.parent == coj_path and path.name in mod_files}:
+                release_tag = await installer.detect_release(changed)
+                log(f'{coj_path}: server list mod files changed ({release_tag or "unknown version"})')
+    finally:
+        watcher.stop()
+        HASH_CACHE.save()
+
+
+async def run_watch(args: argparse.Namespace, coj_paths: list[Path]) -> tuple[int, dict]:
+    async with asyncio.TaskGroup() as tg:
+        for coj_path in coj_paths:
+            tg.create_task(watch_install(args, coj_path))
+    return EXIT_ERROR, {}
+
+
+def get_folders(args: argparse.Namespace) -> list[Path]:
+    if not args.folder:
+        start_folder = cached_start_folder()
+        return [start_folder] if start_folder else []
+    if len(args.folder) == 1 and not any(c in args.folder[0] for c in '*?['):
+        folder = Path(args.folder[0]).expanduser()
+        return [folder] if folder.exists() else []
+    return find_installs(args.folder)
+
+
+async def run_each(args: argparse.Namespace, coj_paths: list[Path], run_func) -> tuple[int, dict]:
+    exit_code, result = EXIT_OK, {}
+    for coj_path in coj_paths:
+        install_exit_code, result[str(coj_path)] = await run_func(args, coj_path)
+        exit_code = max(exit_code, install_exit_code)
+    if len(coj_paths) == 1:
+        return exit_code, result[str(coj_paths[0])]
+    return exit_code, {'installs': result}
+
+
+async def run(args: argparse.Namespace) -> int:
+    SCHEDULER.configure(hash_workers=args.hash_workers, downloads=args.downloads, max_downloads=args.max_downloads,
+                        bandwidth_limit=args.bandwidth_limit)
+    HASH_ENGINE.set_workers(args.hash_workers)
+    configure_backups(args.keep_backups, args.backup_limit, args.compress_backups or None)
+    if args.command == 'cache-server':
+        try:
+            await serve(args.host, args.port, not args.no_announce, log)
+        finally:
+            await HTTP_CLIENT.aclose()
+        return EXIT_OK
+    args.sources, args.mod_url = CUSTOM_MAP_SOURCES, SERVER_LIST_MOD_URL
+    if args.cache:
+        cache_url = await discover_cache() if args.cache == 'auto' else args.cache.rstrip('/') + '/'
+        if cache_url:
+            log(f'using cache server {cache_url}')
+            args.sources, args.mod_url = cache_sources(cache_url), cache_mod_url(cache_url)
+        else:
+            log('no cache server found, downloading directly.')
+    coj_paths = get_folders(args)
+    if not coj_paths:
+        log('folder not found!')
+        return EXIT_ERROR
+    try:
+        with contextlib.redirect_stdout(sys.stderr) if args.json else contextlib.nullcontext():
+            if args.command == 'server-mod':
+                exit_code, result = await run_each(args, coj_paths, run_server_mod)
+            elif args.command == 'export':
+                exit_code, result = await run_export(args, coj_paths[0])
+            elif args.command == 'import':
+                exit_code, result = await run_each(args, coj_paths, run_import)
+            elif args.command == 'watch':
+                exit_code, result = await run_watch(args, coj_paths)
+            elif len(coj_paths) > 1 and args.command != 'prune':
+                exit_code, result = await run_fleet(args, coj_paths)
+            else:
+                exit_code, result = await run_each(args, coj_paths, run_maps)
+    finally:
+        await HTTP_CLIENT.aclose()
+        if args.trace:
+            TRACER.write_trace(args.trace)
+        if args.metrics:
+            TRACER.write_metrics(args.metrics)
+    if args.json:
+        result.update({'command': args.command, 'folders': [str(coj_path) for coj_path in coj_paths],
+                       'exit_code': exit_code})
+        if args.metrics:
+            result['metrics'] = TRACER.summary()
+        print(json.dumps(result, indent=1))
+    return exit_code
+
+
+def main(argv: list[str]) -> int:
+    try:
+        return asyncio.run(run(parse_args(argv)))
+    except KeyboardInterrupt:
+        return EXIT_OK
@@ -1,9 +1,8 @@
 import json
 from typing import Any
 
-import httpx
-
 import constants
+from http_client import HTTP_CLIENT
 
 
 class Config(dict[str, Any]):
@@ -15,9 +14,8 @@ class Config(dict[str, Any]):
             self[name] = value
 
     async def download_json(self):
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                'https://raw.githubusercontent.com/jesseklm/coj-maps-downloader/refs/heads/master/config.json')
+        response = await HTTP_CLIENT.get(
+            'https://raw.githubusercontent.com/jesseklm/coj-maps-downloader/refs/heads/master/config.json')
         response.raise_for_status()
         data = json.loads(response.text)
         data.pop('__meta__', None)
@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import mmap
+import os
+from pathlib import Path
+from typing import Callable
+
+import anyio
+import httpx
+
+from hash_cache import HASH_CACHE
+from hashing import HASH_ENGINE, sha256_sync
+from http_client import HTTP_CLIENT
+from scheduler import SCHEDULER
+from tracing import TRACER
+from utils import CHUNK_SIZE, fsync_file
+
+BLOCK_INDEX_SUFFIX = '.blocks.json'
+BLOCK_SIZE = 64 * 1024
+ROLLING_SCAN_LIMIT = 1024 * 1024
+ROLLING_MISS_LIMIT = 2 * BLOCK_SIZE
+MODULUS = 1 << 16
+
+
+def weak_checksum(data) -> tuple[int, int]:
+    return sum(data) % MODULUS, sum(itertools.accumulate(data)) % MODULUS
+
+
+def strong_checksum(data) -> str:
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def build_block_index(path: Path, block_size=BLOCK_SIZE) -> dict:
+    blocks = []
+    h = hashlib.sha256()
+    with path.open('rb') as f:
+        while block := f.read(block_size):
+            h.update(block)
+            a, b = weak_checksum(block)
+            blocks.append([(b << 16) | a, strong_checksum(block)])
+    return {'version': 1, 'size': path.stat().st_size, 'block_size': block_size, 'sha256': h.hexdigest(),
+            'blocks': blocks}
+
+
+def write_block_index(path: Path, block_size=BLOCK_SIZE) -> Path:
+    index_path = path.with_name(path.name + BLOCK_INDEX_SUFFIX)
+    with index_path.open('w', encoding='utf-8') as f:
+        json.dump(build_block_index(path, block_size), f)
+    return index_path
+
+
+def block_length(index: dict, n: int) -> int:
+    return min(index['block_size'], index['size'] - n * index['block_size'])
+
+
+def match_blocks(index: dict, candidates: list[Path]) -> dict[int, tuple[Path, int]]:
+    block_size = index['block_size']
+    blocks = index['blocks']
+    by_weak: dict[int, list[int]] = {}
+    for n, (weak, _) in enumerate(blocks):
+        if block_length(index, n) == block_size:
+            by_weak.setdefault(weak, []).append(n)
+    matches: dict[int, tuple[Path, int]] = {}
+    scanned = 0
+
+    def try_match(data, weak: int, path: Path, offset: int) -> int | None:
+        numbers = [n for n in by_weak.get(weak, ()) if n not in matches]
+        if not numbers:
+            return None
+        strong = strong_checksum(data[offset:offset + block_size])
+        found = [n for n in numbers if blocks[n][1] == strong]
+        for n in found:
+            matches[n] = (path, offset)
+        return found[0] if found else None
+
+    def follow(data, size: int, path: Path, n: int, offset: int) -> int:
+        while n < len(blocks) and n not in matches:
+            length = block_length(index, n)
+            if offset + length > size or strong_checksum(data[offset:offset + length]) != blocks[n][1]:
+                break
+            matches[n] = (path, offset)
+            offset += length
+            n += 1
+        return offset
+
+    for path in candidates:
+        if len(matches) == len(blocks):
+            break
+        try:
+            f = path.open('rb')
+        except OSError:
+            continue
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                continue
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                covered = set()
+                for offset in range(0, size, block_size):
+                    if offset // block_size < len(blocks):
+                        end = follow(data, size, path, offset // block_size, offset)
+                        covered.update(range(offset, end, block_size))
+                offset = 0
+                rolling = False
+                misses = 0
+                while offset + block_size <= size and len(matches) < len(blocks):
+                    if offset in covered:
+                        offset += block_size
+                        rolling = False
+                        misses = 0
+                        continue
+                    if scanned >= ROLLING_SCAN_LIMIT or misses >= ROLLING_MISS_LIMIT:
+                        break
+                    if not rolling:
+                        a, b = weak_checksum(data[offset:offset + block_size])
+                        rolling = True
+                    weak = (b << 16) | a
+                    if weak in by_weak and (n := try_match(data, weak, path, offset)) is not None:
+                        offset = follow(data, size, path, n + 1, offset + block_size)
+                        rolling = False
+                        misses = 0
+                        continue
+                    if offset + block_size == size:
+                        break
+                    out_byte, in_byte = data[offset], data[offset + block_size]
+                    a = (a - out_byte + in_byte) % MODULUS
+                    b = (b - block_size * out_byte + a) % MODULUS
+                    offset += 1
+                    scanned += 1
+                    misses += 1
+                last = len(blocks) - 1
+                tail = block_length(index, last) if last >= 0 else 0
+                if last >= 0 and last not in matches and tail <= size:
+                    follow(data, size, path, last, size - tail)
+    return matches
+
+
+def missing_ranges(index: dict, matches: dict[int, tuple[Path, int]]) -> list[tuple[int, int]]:
+    ranges = []
+    for n in range(len(index['blocks'])):
+        if n in matches:
+            continue
+        start = n * index['block_size']
+        end = start + block_length(index, n)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def copy_blocks(index: dict, matches: dict[int, tuple[Path, int]], tmp_path: Path):
+    block_size = index['block_size']
+    files = {}
+    try:
+        with tmp_path.open('r+b') as out:
+            for n, (path, offset) in sorted(matches.items()):
+                if path not in files:
+                    files[path] = path.open('rb')
+                out.seek(n * block_size)
+                out.write(os.pread(files[path].fileno(), block_length(index, n), offset))
+    finally:
+        for f in files.values():
+            f.close()
+
+
+async def fetch_block_index(url: str, expected_hash: str) -> dict | None:
+    try:
+        response = await HTTP_CLIENT.get(url + BLOCK_INDEX_SUFFIX)
+        response.raise_for_status()
+        index = response.json()
+    except (httpx.HTTPError, ValueError):
+        return None
+    if index.get('version') != 1 or index.get('sha256') != expected_hash:
+        return None
+    return index
+
+
+async def fetch_range(url: str, tmp_path: Path, start: int, end: int, progress_func: Callable[[int], None],
+                      trace_key: str | None):
+    headers = {'Range': f'bytes={start}-{end - 1}'}
+    async with HTTP_CLIENT.stream('GET', url, headers=headers) as response:
+        response.raise_for_status()
+        if response.status_code != 206 or \
+                not response.headers.get('Content-Range', '').startswith(f'bytes {start}-{end - 1}/'):
+            raise httpx.HTTPError(f'range requests not supported for {url}')
+        offset = start
+        async with await anyio.open_file(tmp_path, 'r+b') as f:
+            await f.seek(start)
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                chunk = chunk[:end - offset]
+                await f.write(chunk)
+                offset += len(chunk)
+                TRACER.count('download_bytes', len(chunk), trace_key)
+                progress_func(len(chunk))
+                await SCHEDULER.transferred(len(chunk))
+                if offset >= end:
+                    break
+    if offset != end:
+        raise httpx.HTTPError(f'short range response for {url}')
+
+
+async def delta_download(url: str, path: Path, expected_hash: str, candidates: list[Path],
+                         progress_func: Callable[[int, int | None], None] = lambda received, total: None,
+                         trace_key: str | None = None, index: dict | None = None) -> str | None:
+    candidates = [candidate for candidate in candidates if candidate.exists()]
+    if not candidates:
+        return None
+    if index is None:
+        with TRACER.span('delta_index', trace_key or 'run'):
+            index = await fetch_block_index(url, expected_hash)
+    if index is None:
+        return None
+    loop = asyncio.get_running_loop()
+    with TRACER.span('delta_match', trace_key or 'run'):
+        matches = await loop.run_in_executor(HASH_ENGINE.executor, match_blocks, index, candidates)
+    if not matches:
+        return None
+    reused = sum(block_length(index, n) for n in matches)
+    TRACER.count('delta_reused_bytes', reused, trace_key)
+    tmp_path = path.with_name(path.name + '.delta')
+    received = reused
+    progress_func(received, index['size'])
+
+    def range_progress(n: int):
+        nonlocal received
+        received += n
+        progress_func(received, index['size'])
+
+    try:
+        with tmp_path.open('wb') as f:
+            f.truncate(index['size'])
+        await loop.run_in_executor(HASH_ENGINE.executor, copy_blocks, index, matches, tmp_path)
+        with TRACER.span('delta_fetch', trace_key or 'run'):
+            for start, end in missing_ranges(index, matches):
+                await fetch_range(url, tmp_path, start, end, range_progress, trace_key)
+        file_hash = await loop.run_in_executor(HASH_ENGINE.executor, sha256_sync, tmp_path)
+        if file_hash != expected_hash:
+            tmp_path.unlink()
+            return None
+        async with await anyio.open_file(tmp_path, 'r+b') as f:
+            await fsync_file(f)
+        tmp_path.replace(path)
+    except (httpx.HTTPError, OSError):
+        tmp_path.unlink(missing_ok=True)
+        return None
+    HASH_CACHE.set(path, file_hash)
+    return file_hash
+
+
+def main():
+    parser = argparse.ArgumentParser(description='write <map>.blocks.json block indexes for delta updates')
+    parser.add_argument('maps', nargs='+', type=Path)
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+    args = parser.parse_args()
+    for path in args.maps:
+        print(write_block_index(path, args.block_size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import asyncio
+import glob
+from pathlib import Path
+from typing import Callable
+
+from constants import CUSTOM_MAP_SOURCES, GAME_EXES
+from map_sync import MapSync, OK_STATUSES
+
+
+def is_install(path: Path) -> bool:
+    return path.is_dir() and ((path / 'CoJ2').is_dir() or any((path / game_exe).exists() for game_exe in GAME_EXES))
+
+
+def find_installs(patterns: list[str]) -> list[Path]:
+    installs = {}
+    for pattern in patterns:
+        for match in sorted(glob.glob(str(Path(pattern).expanduser()), recursive=True)) or [pattern]:
+            path = Path(match).resolve()
+            if path.is_file() and path.name in GAME_EXES:
+                path = path.parent
+            if is_install(path):
+                installs[path] = None
+    return list(installs)
+
+
+class FleetSync:
+    def __init__(self, coj_paths: list[Path], log_func: Callable[[str], None] = lambda message: None,
+                 status_func: Callable[[Path, str, str], None] = lambda coj_path, map_file, status: None,
+                 delta=False, bulk='auto', sources: dict[str, dict[str, str]] = CUSTOM_MAP_SOURCES):
+        self.coj_paths = coj_paths
+        self.sources = sources
+        self.delta = delta
+        self.bulk = bulk
+        self.log_func = log_func
+        self.status_func = status_func
+        self.downloads: dict[tuple, asyncio.Future] = {}
+        self.map_syncs = {coj_path: self.create_map_sync(coj_path) for coj_path in coj_paths}
+        self.results: dict[Path, bool] = {}
+
+    def create_map_sync(self, coj_path: Path) -> MapSync:
+        map_sync = MapSync(lambda message: self.log_func(f'{coj_path}: {message}'), downloads=self.downloads,
+                           delta=self.delta, bulk=self.bulk, sources=self.sources)
+        map_sync.status_func = lambda i, status: self.status_func(coj_path, map_sync.map_files[i], status)
+        return map_sync
+
+    async def sync_install(self, coj_path: Path, source_name: str, download: bool, deep: bool):
+        self.results[coj_path] = await self.map_syncs[coj_path].sync_maps(coj_path, source_name, download, deep)
+
+    async def sync_maps(self, source_name: str, download: bool, deep=False) -> bool:
+        if not self.coj_paths:
+            self.log_func('no installs found!')
+            return False
+        manifest_sync = MapSync(self.log_func, sources=self.sources)
+        if not await manifest_sync.fetch_maps(source_name):
+            return False
+        for map_sync in self.map_syncs.values():
+            map_sync.set_maps(source_name, manifest_sync.manifest)
+        async with asyncio.TaskGroup() as tg:
+            for coj_path in self.coj_paths:
+                tg.create_task(self.sync_install(coj_path, source_name, download, deep))
+        return all(self.results.values())
+
+    def install_ok(self, coj_path: Path) -> bool:
+        map_sync = self.map_syncs[coj_path]
+        return self.results.get(coj_path, False) and all(status in OK_STATUSES for status in map_sync.statuses)
+
+    def report(self) -> dict[str, dict]:
+        return {str(coj_path): {'ok': self.install_ok(coj_path), 'maps': map_sync.results(),
+                                'orphans': map_sync.orphans}
+                for coj_path, map_sync in self.map_syncs.items()}
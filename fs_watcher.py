@@ -0,0 +1,138 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+import sys
+from pathlib import Path
+from typing import Callable
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+DEBOUNCE = 0.5
+POLL_INTERVAL = 2.0
+
+
+def load_inotify():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+def scan_folder(folder: Path) -> dict[Path, tuple[int, int, int]]:
+    entries = {}
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                try:
+                    if entry.is_file():
+                        st = entry.stat()
+                        entries[Path(entry.path)] = (st.st_size, st.st_mtime_ns, st.st_ino)
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return entries
+
+
+class FileWatcher:
+    def __init__(self, folders: list[Path], callback: Callable[[set[Path]], None], debounce=DEBOUNCE,
+                 poll_interval=POLL_INTERVAL, use_inotify=True):
+        self.folders = folders
+        self.callback = callback
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.pending: set[Path] = set()
+        self.flush_handle: asyncio.TimerHandle | None = None
+        self.fd: int | None = None
+        self.watches: dict[int, Path] = {}
+        self.poll_task: asyncio.Task | None = None
+
+    @property
+    def mode(self) -> str:
+        return 'inotify' if self.fd is not None else 'polling'
+
+    def start(self):
+        libc = load_inotify() if self.use_inotify else None
+        if libc is not None:
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+                for folder in self.folders:
+                    wd = libc.inotify_add_watch(fd, os.fsencode(folder), WATCH_MASK)
+                    if wd >= 0:
+                        self.watches[wd] = folder
+                try:
+                    asyncio.get_running_loop().add_reader(fd, self.read_events)
+                    return
+                except NotImplementedError:
+                    os.close(fd)
+                    self.fd = None
+                    self.watches = {}
+        self.poll_task = asyncio.ensure_future(self.poll())
+
+    def stop(self):
+        if self.fd is not None:
+            asyncio.get_running_loop().remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+            self.watches = {}
+        if self.poll_task is not None:
+            self.poll_task.cancel()
+            self.poll_task = None
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        self.pending = set()
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                for folder in self.watches.values():
+                    self.pending.update(scan_folder(folder))
+            elif name and wd in self.watches:
+                self.pending.add(self.watches[wd] / os.fsdecode(name))
+        self.schedule_flush()
+
+    async def poll(self):
+        snapshots = {folder: scan_folder(folder) for folder in self.folders}
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            for folder in self.folders:
+                snapshot = await asyncio.to_thread(scan_folder, folder)
+                old = snapshots[folder]
+                self.pending.update(path for path in snapshot.keys() | old.keys()
+                                    if snapshot.get(path) != old.get(path))
+                snapshots[folder] = snapshot
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        if self.pending and self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.debounce, self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        paths, self.pending = self.pending, set()
+        if paths:
+            self.callback(paths)
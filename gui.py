@@ -0,0 +1,358 @@
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+from PySide6.QtCore import QTimer
+from PySide6.QtWidgets import QApplication, QMainWindow, QFileDialog, QAbstractItemView, QHeaderView, QLabel
+from qasync import asyncSlot, QEventLoop
+
+from app_state import load_state, save_state
+from constants import CUSTOM_MAP_SOURCES, GAME_EXES
+from install_discovery import cached_start_folder
+from map_table_model import MapTableModel, format_bytes
+from tracing import TRACER
+from ui.main import Ui_MainWindow
+
+RATE_INTERVAL_MS = 500
+
+
+class MainWindow(Ui_MainWindow):
+    def __init__(self):
+        self.tasks = set()
+        self.main_window = QMainWindow()
+        self.setupUi(self.main_window)
+        self.pushButtonFolder.clicked.connect(self.select_folder)
+        self.pushButtonFetch.clicked.connect(self.fetch_maps_clicked)
+        self.pushButtonCheck.clicked.connect(self.check_maps)
+        self.pushButtonUpdate.clicked.connect(self.update_maps)
+        self.pushButtonPrune.clicked.connect(self.prune_maps)
+        self.pushButtonServerMod.clicked.connect(self.apply_mod)
+        self.checkBoxWatch.toggled.connect(self.toggle_watch)
+        self.push_buttons = [self.pushButtonFolder, self.pushButtonFetch, self.pushButtonCheck, self.pushButtonUpdate,
+                             self.pushButtonPrune, self.pushButtonServerMod]
+
+        for source_name, source in CUSTOM_MAP_SOURCES.items():
+            self.comboBoxSource.addItem(source_name, source)
+
+        self.table_model = MapTableModel(self.main_window)
+        self.table_model.rows_changed.connect(self.rows_changed)
+        self.tableView.setModel(self.table_model)
+        self.tableView.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.tableView.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+        self.tableView.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Interactive)
+        self.tableView.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        self.scroll_index = 0
+        self.shown_source = ''
+
+        self.rate_label = QLabel()
+        self.statusbar.addPermanentWidget(self.rate_label)
+        self.rate_timer = QTimer(self.main_window)
+        self.rate_timer.setInterval(RATE_INTERVAL_MS)
+        self.rate_timer.timeout.connect(self.update_rate)
+        self.rate_sample = (0.0, 0)
+        self.rate = 0.0
+
+        self.map_sync = None
+        self.watcher = None
+        self.watch_path: Path | None = None
+        self.busy = False
+        self.verifying = False
+        self.changed_paths: set[Path] = set()
+        self.spinBoxDownloads.valueChanged.connect(self.configure_scheduler)
+        self.spinBoxBandwidth.valueChanged.connect(self.configure_scheduler)
+        self.spinBoxKeepBackups.valueChanged.connect(self.configure_backups)
+        self.spinBoxBackupLimit.valueChanged.connect(self.configure_backups)
+        self.checkBoxCompressBackups.toggled.connect(self.configure_backups)
+
+        self.find_start_folder()
+        self.restore_snapshot()
+
+    def show(self):
+        self.main_window.show()
+
+    def get_map_sync(self):
+        if self.map_sync is None:
+            from map_sync import MapSync
+            self.map_sync = MapSync(self.statusbar.showMessage, self.table_model.set_status, self.show_maps,
+                                    self.table_model.set_progress)
+            self.configure_scheduler()
+            self.configure_backups()
+        return self.map_sync
+
+    def configure_scheduler(self):
+        if self.map_sync is None:
+            return
+        from scheduler import SCHEDULER
+        SCHEDULER.configure(max_downloads=self.spinBoxDownloads.value(),
+                            bandwidth_limit=self.spinBoxBandwidth.value() * 1024)
+
+    def configure_backups(self):
+        if self.map_sync is None:
+            return
+        from backup_catalog import configure_backups
+        configure_backups(self.spinBoxKeepBackups.value(), self.spinBoxBackupLimit.value() * 1024 ** 2,
+                          self.checkBoxCompressBackups.isChecked())
+
+    def restore_snapshot(self):
+        snapshot = load_state()
+        if not snapshot.get('manifest') or snapshot.get('folder') != self.lineEditFolder.text():
+            return
+        index = self.comboBoxSource.findText(snapshot.get('source', ''))
+        if index < 0:
+            return
+        self.comboBoxSource.setCurrentIndex(index)
+        self.table_model.set_maps(list(snapshot['manifest']))
+        for i, status in enumerate(snapshot.get('statuses', [])[:len(snapshot['manifest'])]):
+            self.table_model.set_status(i, status)
+        self.shown_source = snapshot['source']
+        self.statusbar.showMessage('last known state restored, revalidating..')
+
+    def save_snapshot(self, coj_path: Path):
+        map_sync = self.get_map_sync()
+        if map_sync.map_dict:
+            save_state(folder=str(coj_path), source=map_sync.map_source, manifest=map_sync.map_dict,
+                       statuses=map_sync.statuses)
+
+    async def revalidate(self):
+        await asyncio.sleep(0)
+        self.get_map_sync()
+        if self.shown_source and self.get_selected_coj_folder():
+            await self.sync_maps(download=False)
+
+    def spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def start(self):
+        self.spawn(self.revalidate())
+
+    def toggle_watch(self, checked: bool):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        if not checked:
+            return
+        coj_path = self.get_selected_coj_folder()
+        if not coj_path:
+            self.checkBoxWatch.setChecked(False)
+            return
+        from fs_watcher import FileWatcher
+        maps_path = coj_path / 'CoJ2' / 'Data' / 'MapsNet'
+        self.watcher = FileWatcher([coj_path] + ([maps_path] if maps_path.is_dir() else []), self.files_changed)
+        self.watch_path = coj_path
+        self.watcher.start()
+        self.statusbar.showMessage(f'watching {coj_path} ({self.watcher.mode})..')
+
+    def files_changed(self, paths: set[Path]):
+        if self.busy:
+            return
+        self.changed_paths |= paths
+        if not self.verifying:
+            self.spawn(self.process_changes())
+
+    async def process_changes(self):
+        from server_mod_installer import ServerModInstaller
+        self.verifying = True
+        try:
+            while self.changed_paths and not self.busy:
+                paths, self.changed_paths = self.changed_paths, set()
+                coj_path = self.watch_path
+                map_sync = self.get_map_sync()
+                if map_sync.map_dict and self.shown_source == map_sync.map_source:
+                    await map_sync.verify_changed(coj_path / 'CoJ2' / 'Data' / 'MapsNet', paths)
+                installer = ServerModInstaller(coj_path, self.statusbar.showMessage)
+                mod_files = {file_name for release in installer.releases.values() for file_name in release}
+                if changed := {path.name for path in paths if path.parent == coj_path and path.name in mod_files}:
+                    release_tag = await installer.detect_release(changed)
+                    self.statusbar.showMessage(f'server list mod files changed ({release_tag or "unknown version"})')
+        finally:
+            self.verifying = False
+
+    def set_buttons(self, status: bool):
+        for push_button in self.push_buttons:
+            push_button.setEnabled(status)
+
+    def disable_input(self):
+        self.busy = True
+        self.set_buttons(False)
+        self.lineEditFolder.setEnabled(False)
+        self.comboBoxSource.setEnabled(False)
+
+    def enable_input(self):
+        self.busy = False
+        self.changed_paths = set()
+        self.set_buttons(True)
+        self.lineEditFolder.setEnabled(True)
+        self.comboBoxSource.setEnabled(True)
+
+    def start_rate(self):
+        TRACER.reset()
+        self.rate_sample = (time.monotonic(), 0)
+        self.rate = 0.0
+        self.rate_label.clear()
+        self.rate_timer.start()
+
+    def stop_rate(self):
+        self.rate_timer.stop()
+        self.rate_label.clear()
+
+    def update_rate(self):
+        now = time.monotonic()
+        from map_sync import PROGRESS_STATUSES
+        received = TRACER.counters['download_bytes']
+        last_time, last_received = self.rate_sample
+        self.rate_sample = (now, received)
+        rate = (received - last_received) / (now - last_time) if now > last_time else 0.0
+        self.rate = rate if not self.rate else self.rate * 0.7 + rate * 0.3
+        if not received:
+            return
+        text = f'{format_bytes(self.rate)}/s'
+        remaining = self.table_model.remaining_bytes(PROGRESS_STATUSES)
+        if remaining and self.rate >= 1:
+            eta = int(remaining / self.rate)
+            text += f' · ETA {eta // 3600}:{eta // 60 % 60:02d}:{eta % 60:02d}'
+        self.rate_label.setText(text)
+
+    def clear_table(self):
+        self.shown_source = ''
+        self.table_model.set_maps([])
+
+    def scroll_up(self):
+        self.scroll_index = 0
+        self.shown_source = ''
+        self.tableView.scrollToTop()
+
+    def rows_changed(self, first: int, last: int):
+        if last > self.scroll_index:
+            self.scroll_index = last
+            self.tableView.scrollTo(self.table_model.index(last, 0))
+
+    def find_start_folder(self) -> str:
+        if not self.lineEditFolder.text():
+            if start_folder := cached_start_folder():
+                self.lineEditFolder.setText(str(start_folder))
+                return str(start_folder)
+        return ''
+
+    def get_selected_coj_folder(self) -> Path | None:
+        if not self.lineEditFolder.text():
+            self.statusbar.showMessage('select folder!')
+            return None
+        coj_path = Path(self.lineEditFolder.text())
+        if coj_path.exists():
+            return coj_path
+        self.statusbar.showMessage('folder not found!')
+        return None
+
+    @asyncSlot()
+    async def select_folder(self):
+        start_folder = self.lineEditFolder.text()
+        if not start_folder:
+            self.find_start_folder()
+        file_path, _ = QFileDialog.getOpenFileName(
+            self.main_window,
+            f'select CoJ:BiB – {GAME_EXES[0]}',
+            start_folder,
+            f'{GAME_EXES[0]} ({GAME_EXES[0]});;Executables (*.exe);;All Files (*)',
+        )
+        if not file_path:
+            self.statusbar.showMessage('select aborted.')
+            return
+        exe_path = Path(file_path).resolve()
+        self.lineEditFolder.setText(str(exe_path.parent))
+
+    def get_maps_source(self) -> str:
+        return self.comboBoxSource.currentText()
+
+    def show_maps(self, map_dict: dict):
+        if self.shown_source != self.get_maps_source() or self.table_model.map_files != list(map_dict):
+            self.table_model.set_maps(list(map_dict))
+            self.shown_source = self.get_maps_source()
+        for i, map_file in enumerate(map_dict):
+            if size := self.map_sync.map_size(map_file):
+                self.table_model.set_size(i, size)
+        self.tableView.scrollToBottom()
+
+    async def fetch_maps(self):
+        self.clear_table()
+        await self.get_map_sync().fetch_maps(self.get_maps_source())
+
+    @asyncSlot()
+    async def fetch_maps_clicked(self):
+        self.disable_input()
+        await self.fetch_maps()
+        self.enable_input()
+
+    async def sync_maps(self, download: bool):
+        self.disable_input()
+        coj_path = self.get_selected_coj_folder()
+        if coj_path:
+            map_sync = self.get_map_sync()
+            if self.shown_source != self.get_maps_source():
+                self.clear_table()
+            self.scroll_up()
+            map_sync.delta = self.checkBoxDelta.isChecked()
+            self.start_rate()
+            try:
+                await map_sync.sync_maps(coj_path, self.get_maps_source(), download,
+                                         self.checkBoxDeepVerify.isChecked())
+            finally:
+                self.stop_rate()
+            self.save_snapshot(coj_path)
+            self.tableView.scrollToBottom()
+        self.enable_input()
+
+    @asyncSlot()
+    async def check_maps(self):
+        await self.sync_maps(download=False)
+
+    @asyncSlot()
+    async def update_maps(self):
+        await self.sync_maps(download=True)
+
+    @asyncSlot()
+    async def prune_maps(self):
+        self.disable_input()
+        if coj_path := self.get_selected_coj_folder():
+            if self.shown_source != self.get_maps_source():
+                self.clear_table()
+            await self.get_map_sync().prune_orphans(coj_path, self.get_maps_source())
+        self.enable_input()
+
+    @asyncSlot()
+    async def apply_mod(self):
+        self.disable_input()
+        coj_path = self.get_selected_coj_folder()
+        if not coj_path:
+            self.enable_input()
+            return
+        from server_mod_installer import ServerModInstaller
+        server_mod_installer = ServerModInstaller(coj_path, lambda x: self.statusbar.showMessage(x),
+                                                  deep=self.checkBoxDeepVerify.isChecked())
+        await server_mod_installer.apply()
+        self.enable_input()
+
+
+async def run(app):
+    app_close_event = asyncio.Event()
+    app.aboutToQuit.connect(app_close_event.set)
+    main_window = MainWindow()
+    main_window.show()
+    main_window.start()
+    await app_close_event.wait()
+    if main_window.map_sync is not None:
+        from hash_cache import HASH_CACHE
+        from http_client import HTTP_CLIENT
+        HASH_CACHE.save()
+        await HTTP_CLIENT.aclose()
+
+
+def main():
+    app = QApplication(sys.argv)
+    asyncio.run(run(app), loop_factory=QEventLoop)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import asyncio
+import json
+import os
+from pathlib import Path
+
+from app_dirs import app_cache_dir
+
+SAVE_DELAY = 5.0
+
+
+class HashCache:
+    def __init__(self, cache_path: Path):
+        self.cache_path = cache_path
+        self.entries: dict[str, list] | None = None
+        self.dirty = False
+        self.save_handle: asyncio.TimerHandle | None = None
+
+    def load(self):
+        if self.entries is not None:
+            return
+        try:
+            with self.cache_path.open('r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    @staticmethod
+    def key(path: Path) -> str:
+        return str(path.absolute())
+
+    @staticmethod
+    def stat_key(st: os.stat_result) -> list:
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def get(self, path: Path, st: os.stat_result) -> str | None:
+        self.load()
+        entry = self.entries.get(self.key(path))
+        if entry and entry[:3] == self.stat_key(st):
+            return entry[3]
+        return None
+
+    def set(self, path: Path, file_hash: str, st: os.stat_result | None = None):
+        self.load()
+        if st is None:
+            st = path.stat()
+        self.entries[self.key(path)] = self.stat_key(st) + [file_hash]
+        self.dirty = True
+
+    def invalidate(self, path: Path):
+        self.load()
+        if self.entries.pop(self.key(path), None):
+            self.dirty = True
+
+    def move(self, src: Path, dst: Path):
+        self.load()
+        entry = self.entries.pop(self.key(src), None)
+        if entry:
+            self.entries[self.key(dst)] = entry
+            self.dirty = True
+        else:
+            self.invalidate(dst)
+
+    def save(self, prune=False):
+        if self.save_handle is not None:
+            self.save_handle.cancel()
+            self.save_handle = None
+        if not self.dirty:
+            return
+        if prune:
+            for key in [key for key in self.entries if not os.path.exists(key)]:
+                del self.entries[key]
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cache_path.with_name(self.cache_path.name + '.tmp')
+        with tmp_path.open('w', encoding='utf-8') as f:
+            json.dump(self.entries, f)
+        tmp_path.replace(self.cache_path)
+        self.dirty = False
+
+    def save_later(self, delay=SAVE_DELAY):
+        if self.dirty and self.save_handle is None:
+            self.save_handle = asyncio.get_running_loop().call_later(delay, self.save)
+
+
+HASH_CACHE = HashCache(app_cache_dir() / 'hashes.json')
@@ -0,0 +1,79 @@
+import asyncio
+import hashlib
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import AsyncIterator, Iterable
+
+from hash_cache import HASH_CACHE
+from tracing import TRACER
+
+
+def sha256_sync(path: Path) -> str:
+    with path.open('rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return hashlib.sha256(m).hexdigest()
+
+
+class HashEngine:
+    def __init__(self, workers=min(8, os.cpu_count() or 4)):
+        self.workers = workers
+        self._executor: ThreadPoolExecutor | None = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='sha256')
+        return self._executor
+
+    def set_workers(self, workers: int | None):
+        if not workers or workers == self.workers:
+            return
+        self.workers = workers
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def hash_file(self, path: Path, deep=False) -> str:
+        st = path.stat()
+        if not deep and (file_hash := HASH_CACHE.get(path, st)):
+            return file_hash
+        with TRACER.span('sha256', path.name, size=st.st_size):
+            file_hash = await asyncio.get_running_loop().run_in_executor(self.executor, sha256_sync, path)
+        TRACER.count('hashed_bytes', st.st_size, path.name)
+        HASH_CACHE.set(path, file_hash, st)
+        return file_hash
+
+    async def hash_one(self, path: Path, deep: bool) -> tuple[Path, str | None]:
+        try:
+            return path, await self.hash_file(path, deep)
+        except OSError:
+            return path, None
+
+    async def hash_batch(self, paths: Iterable[Path], deep=False) -> AsyncIterator[tuple[Path, str | None]]:
+        uncached = []
+        for path in paths:
+            try:
+                st = path.stat()
+            except OSError:
+                yield path, None
+                continue
+            if not deep and (file_hash := HASH_CACHE.get(path, st)):
+                yield path, file_hash
+            else:
+                uncached.append((st.st_size, path))
+        uncached.sort(reverse=True)
+        pending = [asyncio.ensure_future(self.hash_one(path, deep)) for _, path in uncached]
+        for future in asyncio.as_completed(pending):
+            yield await future
+
+    async def hash_all(self, paths: Iterable[Path], deep=False) -> dict[Path, str | None]:
+        return {path: file_hash async for path, file_hash in self.hash_batch(paths, deep)}
+
+
+HASH_ENGINE = HashEngine()
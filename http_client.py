@@ -0,0 +1,95 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable
+from urllib.parse import urlsplit
+
+import httpx
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class HttpClient:
+    def __init__(self, max_connections=16, max_connections_per_host=12, retries=3, backoff=0.5, timeout=30.0,
+                 http2=HTTP2_AVAILABLE):
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self._client: httpx.AsyncClient | None = None
+        self._host_sems: dict[str, asyncio.Semaphore] = {}
+        self.status_listeners: list[Callable[[int], None]] = []
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=self.http2,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                timeout=httpx.Timeout(self.timeout, connect=10.0),
+            )
+        return self._client
+
+    def host_sem(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self._host_sems:
+            self._host_sems[host] = asyncio.Semaphore(self.max_connections_per_host)
+        return self._host_sems[host]
+
+    def retry_delay(self, attempt: int, response: httpx.Response | None = None) -> float:
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return float(retry_after)
+        return self.backoff * 2 ** attempt
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        async with self.stream(method, url, **kwargs) as response:
+            await response.aread()
+        return response
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('GET', url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, follow_redirects=False, **kwargs) -> AsyncIterator[httpx.Response]:
+        async with self.host_sem(url):
+            for attempt in range(self.retries + 1):
+                last_attempt = attempt == self.retries
+                try:
+                    response = await self.client.send(self.client.build_request(method, url, **kwargs), stream=True,
+                                                      follow_redirects=follow_redirects)
+                except httpx.TransportError:
+                    if last_attempt:
+                        raise
+                    await asyncio.sleep(self.retry_delay(attempt))
+                    continue
+                if response.status_code in RETRY_STATUS_CODES:
+                    for status_listener in self.status_listeners:
+                        status_listener(response.status_code)
+                if response.status_code in RETRY_STATUS_CODES and not last_attempt:
+                    await response.aclose()
+                    await asyncio.sleep(self.retry_delay(attempt, response))
+                    continue
+                break
+            try:
+                yield response
+            finally:
+                await response.aclose()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+HTTP_CLIENT = HttpClient()
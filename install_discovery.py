@@ -0,0 +1,40 @@
+import sys
+from pathlib import Path
+
+from app_state import load_state, save_state
+from constants import LINUX_PATH, GAME_EXES, WINDOWS_REG_KEYS
+
+
+def is_game_folder(path: Path) -> bool:
+    return any((path / game_exe).exists() for game_exe in GAME_EXES)
+
+
+def find_start_folder() -> Path | None:
+    if sys.platform.startswith('linux'):
+        linux_folder = Path.home() / LINUX_PATH
+        for game_exe in GAME_EXES:
+            if (linux_folder / game_exe).exists():
+                return linux_folder.resolve()
+    elif sys.platform == 'win32':
+        import winreg
+        for wow_flag in (winreg.KEY_WOW64_64KEY, winreg.KEY_WOW64_32KEY):
+            for reg_path, reg_name in WINDOWS_REG_KEYS:
+                try:
+                    with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, reg_path,
+                                        access=winreg.KEY_READ | wow_flag) as key:
+                        value, reg_type = winreg.QueryValueEx(key, reg_name)
+                except Exception:
+                    continue
+                windows_folder = Path(value)
+                for game_exe in GAME_EXES:
+                    if (windows_folder / game_exe).exists():
+                        return windows_folder.resolve()
+    return None
+
+
+def cached_start_folder() -> Path | None:
+    if (folder := load_state().get('folder')) and is_game_folder(Path(folder)):
+        return Path(folder)
+    if start_folder := find_start_folder():
+        save_state(folder=str(start_folder))
+    return start_folder
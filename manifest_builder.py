@@ -0,0 +1,91 @@
+import argparse
+import json
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from delta import BLOCK_INDEX_SUFFIX, BLOCK_SIZE, build_block_index
+from hashing import sha256_sync
+from manifest_cache import MANIFEST_VERSION, parse_manifest
+
+
+def build_entry(path: Path, blocks=False, block_size=BLOCK_SIZE) -> dict:
+    st = path.stat()
+    if not blocks:
+        return {'size': st.st_size, 'mtime': int(st.st_mtime), 'sha256': sha256_sync(path)}
+    index = build_block_index(path, block_size)
+    return {'size': index['size'], 'mtime': int(st.st_mtime), 'sha256': index['sha256'], 'block_size': block_size,
+            'blocks': index['blocks']}
+
+
+def is_reusable(entry: dict, path: Path, blocks: bool, block_size: int) -> bool:
+    st = path.stat()
+    if entry.get('size') != st.st_size or entry.get('mtime') != int(st.st_mtime):
+        return False
+    return not blocks or entry.get('block_size') == block_size
+
+
+def map_paths(maps_path: Path) -> list[Path]:
+    return sorted(path for path in maps_path.iterdir() if path.is_file() and not path.name.startswith('.')
+                  and not path.name.endswith(BLOCK_INDEX_SUFFIX))
+
+
+def build_manifest(maps_path: Path, blocks=False, block_size=BLOCK_SIZE, workers: int | None = None,
+                   previous: dict[str, dict] | None = None) -> dict:
+    entries = {}
+    todo = []
+    for path in map_paths(maps_path):
+        entry = (previous or {}).get(path.name)
+        if entry and is_reusable(entry, path, blocks, block_size):
+            if not blocks:
+                entry = {key: entry[key] for key in ('size', 'mtime', 'sha256')}
+            entries[path.name] = entry
+        else:
+            entries[path.name] = None
+            todo.append(path)
+    with ProcessPoolExecutor(workers) as executor:
+        for path, entry in zip(todo, executor.map(build_entry, todo, [blocks] * len(todo),
+                                                  [block_size] * len(todo))):
+            entries[path.name] = entry
+    return {'version': MANIFEST_VERSION, 'maps': entries}
+
+
+def load_previous(path: Path) -> dict[str, dict] | None:
+    try:
+        with path.open('r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        return parse_manifest(manifest) if 'version' in manifest else None
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path: Path, payload: dict, indent: int | None = 1):
+    tmp_path = path.with_name(path.name + '.tmp')
+    with tmp_path.open('w', encoding='utf-8') as f:
+        json.dump(payload, f, indent=indent)
+    tmp_path.replace(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='write a v2 manifest (size, mtime, sha256 and optional block '
+                                                 'checksums) for a maps folder, hashing on all cores')
+    parser.add_argument('maps', type=Path)
+    parser.add_argument('-o', '--output', type=Path, default=Path('manifest.json'))
+    parser.add_argument('--blocks', action='store_true',
+                        help='include block checksums for delta updates and verified segmented downloads')
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+    parser.add_argument('--workers', type=int, help='number of hashing processes (default: all cores)')
+    parser.add_argument('--rehash', action='store_true',
+                        help='hash every map instead of reusing entries whose size and mtime are unchanged')
+    parser.add_argument('--v1-output', type=Path,
+                        help='also write the flat {map: sha256} manifest read by older versions')
+    args = parser.parse_args()
+    previous = None if args.rehash else load_previous(args.output)
+    manifest = build_manifest(args.maps, args.blocks, args.block_size, args.workers, previous)
+    write_json(args.output, manifest, None if args.blocks else 1)
+    if args.v1_output:
+        write_json(args.v1_output, {map_file: entry['sha256'] for map_file, entry in manifest['maps'].items()})
+    print(f'{len(manifest["maps"])} maps written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
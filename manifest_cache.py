@@ -0,0 +1,92 @@
+import hashlib
+import json
+from pathlib import Path
+
+from app_dirs import app_cache_dir
+from http_client import HTTP_CLIENT
+
+MANIFEST_VERSION = 2
+
+
+def is_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def check_entry(map_file: str, entry: dict):
+    if not isinstance(entry['sha256'], str):
+        raise TypeError(f'{map_file}: sha256 is not a string')
+    if 'size' in entry and not is_int(entry['size']):
+        raise TypeError(f'{map_file}: size is not an integer')
+    if 'blocks' not in entry:
+        return
+    block_size = entry.get('block_size')
+    if 'size' not in entry or not is_int(block_size) or not block_size:
+        raise TypeError(f'{map_file}: blocks need size and block_size')
+    blocks = entry['blocks']
+    if not isinstance(blocks, list) or len(blocks) != -(-entry['size'] // block_size):
+        raise TypeError(f'{map_file}: wrong number of blocks')
+    if not all(isinstance(block, list) and len(block) == 2 and is_int(block[0]) and isinstance(block[1], str)
+               for block in blocks):
+        raise TypeError(f'{map_file}: malformed block checksums')
+
+
+def parse_manifest(manifest: dict) -> dict[str, dict]:
+    if 'version' not in manifest:
+        return {map_file: {'sha256': map_hash} for map_file, map_hash in manifest.items()}
+    if manifest['version'] != MANIFEST_VERSION:
+        raise ValueError(f'unsupported manifest version {manifest["version"]}')
+    try:
+        entries = manifest['maps']
+        for map_file, entry in entries.items():
+            check_entry(map_file, entry)
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f'malformed manifest: {e}') from e
+    return entries
+
+
+def manifest_hashes(manifest: dict) -> dict[str, str]:
+    return {map_file: entry['sha256'] for map_file, entry in parse_manifest(manifest).items()}
+
+
+class ManifestCache:
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = cache_dir
+
+    def cache_path(self, url: str) -> Path:
+        return self.cache_dir / (hashlib.sha256(url.encode()).hexdigest()[:16] + '.json')
+
+    def load(self, url: str) -> dict | None:
+        try:
+            with self.cache_path(url).open('r', encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return cached if cached.get('url') == url else None
+
+    def store(self, url: str, cached: dict):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        cache_path = self.cache_path(url)
+        tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+        with tmp_path.open('w', encoding='utf-8') as f:
+            json.dump(cached, f)
+        tmp_path.replace(cache_path)
+
+    async def fetch(self, url: str) -> dict:
+        cached = self.load(url)
+        headers = {}
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        response = await HTTP_CLIENT.get(url, headers=headers)
+        if cached and response.status_code == 304:
+            return cached['manifest']
+        response.raise_for_status()
+        manifest = json.loads(response.text)
+        self.store(url, {'url': url, 'etag': response.headers.get('ETag'),
+                         'last_modified': response.headers.get('Last-Modified'), 'manifest': manifest})
+        return manifest
+
+
+MANIFEST_CACHE = ManifestCache(app_cache_dir() / 'manifests')
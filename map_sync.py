@@ -0,0 +1,436 @@
+import asyncio
+import json
+from pathlib import Path
+from typing import Callable
+
+import httpx
+
+from backup_catalog import get_catalog, save_catalogs
+from blob_store import BLOB_STORE, copy_verified
+from bulk_archive import archive_source, bulk_download, prefer_bulk, DEFAULT_BANDWIDTH, DEFAULT_MAP_SIZE, \
+    REQUEST_OVERHEAD
+from constants import CUSTOM_MAP_SOURCES
+from delta import delta_download
+from hash_cache import HASH_CACHE
+from hashing import HASH_ENGINE
+from manifest_cache import MANIFEST_CACHE, manifest_hashes, parse_manifest
+from scheduler import SCHEDULER, TransferScheduler
+from segmented import segmented_download, SEGMENT_THRESHOLD
+from tracing import TRACER
+from utils import sha256_file, download_to_file
+
+OK_STATUSES = ('ok',)
+PROGRESS_STATUSES = ('queued', 'waiting', 'downloading')
+APPLIED_MANIFEST_NAME = '.applied_manifest.json'
+
+
+def load_applied(maps_path: Path) -> dict[str, str]:
+    try:
+        with (maps_path / APPLIED_MANIFEST_NAME).open('r', encoding='utf-8') as f:
+            return json.load(f)['manifest']
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def save_applied(maps_path: Path, source_name: str, manifest: dict[str, str]):
+    applied_path = maps_path / APPLIED_MANIFEST_NAME
+    tmp_path = applied_path.with_name(APPLIED_MANIFEST_NAME + '.tmp')
+    with tmp_path.open('w', encoding='utf-8') as f:
+        json.dump({'source': source_name, 'manifest': manifest}, f, indent=1)
+    tmp_path.replace(applied_path)
+
+
+def diff_manifests(old: dict[str, str], new: dict[str, str]) -> tuple[list[str], list[str], list[str]]:
+    added = [map_file for map_file in new if map_file not in old]
+    changed = [map_file for map_file, map_hash in new.items() if map_file in old and old[map_file] != map_hash]
+    removed = [map_file for map_file in old if map_file not in new]
+    return added, changed, removed
+
+
+def get_maps_path(coj_path: Path, log_func: Callable[[str], None], create=False) -> Path | None:
+    coj2_path = coj_path / 'CoJ2'
+    if not coj2_path.exists():
+        log_func('CoJ2-folder is missing!')
+        return None
+    data_path = coj2_path / 'Data'
+    if not data_path.exists():
+        log_func('Data-folder is missing!')
+        return None
+    maps_path = data_path / 'MapsNet'
+    if create:
+        maps_path.mkdir(exist_ok=True)
+    return maps_path
+
+
+class MapSync:
+    def __init__(self, log_func: Callable[[str], None] = lambda message: None,
+                 status_func: Callable[[int, str], None] = lambda i, status: None,
+                 maps_func: Callable[[dict], None] = lambda map_dict: None,
+                 progress_func: Callable[[int, int, int | None], None] = lambda i, received, total: None,
+                 scheduler: TransferScheduler = SCHEDULER, downloads: dict[tuple, asyncio.Future] | None = None,
+                 sources: dict[str, dict[str, str]] = CUSTOM_MAP_SOURCES, delta=False, bulk='auto'):
+        self.log_func = log_func
+        self.status_func = status_func
+        self.maps_func = maps_func
+        self.progress_func = progress_func
+        self.sources = sources
+        self.delta = delta
+        self.bulk = bulk
+        self.map_source = ''
+        self.manifest: dict | None = None
+        self.map_dict: dict | None = None
+        self.map_entries: dict[str, dict] = {}
+        self.map_files: list[str] = []
+        self.statuses: list[str] = []
+        self.orphans: list[str] = []
+        self.mirrors: dict[str, list[str]] | None = None
+        self.scheduler = scheduler
+        self.downloads = {} if downloads is None else downloads
+
+    def set_map_status(self, i: int, status: str):
+        self.statuses[i] = status
+        self.status_func(i, status)
+
+    def results(self) -> dict[str, str]:
+        return dict(zip(self.map_files, self.statuses))
+
+    def all_ok(self) -> bool:
+        return bool(self.map_dict) and all(status in OK_STATUSES for status in self.statuses)
+
+    async def fetch_maps(self, source_name: str) -> bool:
+        self.log_func('fetching map-list..')
+        self.map_source = ''
+        self.map_dict = None
+        self.map_files = []
+        self.statuses = []
+        url = self.sources[source_name]['manifest']
+        try:
+            try:
+                manifest = await MANIFEST_CACHE.fetch(url)
+            except httpx.HTTPError as e:
+                if not (cached := MANIFEST_CACHE.load(url)):
+                    raise
+                self.log_func(f'{e}, using the cached map-list.')
+                manifest = cached['manifest']
+            self.set_maps(source_name, manifest)
+        except (httpx.HTTPError, ValueError) as e:
+            self.log_func(str(e))
+            return False
+        self.log_func('map-list fetched.')
+        return True
+
+    def set_maps(self, source_name: str, manifest: dict):
+        self.map_entries = parse_manifest(manifest)
+        self.manifest = manifest
+        self.map_dict = {map_file: entry['sha256'] for map_file, entry in self.map_entries.items()}
+        self.map_source = source_name
+        self.map_files = list(self.map_dict)
+        self.statuses = [''] * len(self.map_dict)
+        self.mirrors = None
+        self.maps_func(self.map_dict)
+
+    def mirror_urls(self, map_file: str, map_hash: str) -> list[str]:
+        if self.mirrors is None:
+            self.mirrors = {}
+            for source_name, source in self.sources.items():
+                if source_name == self.map_source:
+                    continue
+                cached = MANIFEST_CACHE.load(source['manifest'])
+                try:
+                    other_dict = manifest_hashes(cached['manifest']) if cached else {}
+                except ValueError:
+                    other_dict = {}
+                for other_file, other_hash in other_dict.items():
+                    self.mirrors.setdefault(other_hash, []).extend(
+                        base + other_file for base in [source['maps'], *source.get('mirrors', ())])
+        source = self.sources[self.map_source]
+        urls = [base + map_file for base in [source['maps'], *source.get('mirrors', ())]]
+        return list(dict.fromkeys(urls + self.mirrors.get(map_hash, [])))
+
+    def map_size(self, map_file: str) -> int | None:
+        return self.map_entries.get(map_file, {}).get('size')
+
+    def block_index(self, map_file: str) -> dict | None:
+        entry = self.map_entries.get(map_file, {})
+        if 'blocks' not in entry or 'size' not in entry:
+            return None
+        return {'version': 1, 'size': entry['size'], 'block_size': entry['block_size'], 'sha256': entry['sha256'],
+                'blocks': entry['blocks']}
+
+    def size_mismatch(self, map_file_path: Path) -> bool:
+        size = self.map_size(map_file_path.name)
+        try:
+            return size is not None and map_file_path.stat().st_size != size
+        except OSError:
+            return False
+
+    async def check_map_hash(self, map_file_path, map_hash, i, deep=False) -> bool:
+        if self.size_mismatch(map_file_path):
+            self.set_map_status(i, 'mismatch')
+            return False
+        with TRACER.span('hash', map_file_path.name, deep=deep):
+            file_hash = await sha256_file(map_file_path, deep)
+        if file_hash == map_hash:
+            await BLOB_STORE.add(map_file_path, map_hash)
+            self.set_map_status(i, 'ok')
+            return True
+        else:
+            self.set_map_status(i, 'mismatch')
+            return False
+
+    async def materialize(self, map_file, map_hash, map_file_path, source_path: Path | None = None) -> bool:
+        with TRACER.span('materialize', map_file):
+            if not await BLOB_STORE.materialize(map_hash, map_file_path) and not (
+                    source_path and await copy_verified(source_path, map_file_path, map_hash)):
+                return False
+        TRACER.count('materialized_maps', 1, map_file)
+        return True
+
+    async def download_map(self, i, map_file, map_hash, map_file_path, size_hint=0):
+        if await self.materialize(map_file, map_hash, map_file_path):
+            self.set_map_status(i, 'ok')
+            return
+        key = (self.map_source, map_file, map_hash)
+        while key in self.downloads:
+            self.set_map_status(i, 'waiting')
+            leader = self.downloads[key]
+            with TRACER.span('dedupe_wait', map_file):
+                await asyncio.shield(leader)
+            if await self.materialize(map_file, map_hash, map_file_path, leader.result()):
+                self.set_map_status(i, 'ok')
+                return
+        self.downloads[key] = asyncio.get_running_loop().create_future()
+        done_path = None
+        try:
+            self.set_map_status(i, 'queued')
+            async with self.scheduler.downloading(size_hint, trace_key=map_file):
+                self.set_map_status(i, 'downloading')
+                url = self.sources[self.map_source]['maps'] + map_file
+                progress_func = lambda received, total: self.progress_func(i, received, total)
+                h = None
+                if self.delta:
+                    candidates = await get_catalog(map_file_path.parent, maps=True).versions(map_file)
+                    with TRACER.span('delta', map_file):
+                        h = await delta_download(url, map_file_path, map_hash, candidates, progress_func, map_file,
+                                                 self.block_index(map_file))
+                urls = self.mirror_urls(map_file, map_hash)
+                if h is None and (len(urls) > 1 or size_hint >= SEGMENT_THRESHOLD):
+                    with TRACER.span('segmented_download', map_file):
+                        h = await segmented_download(urls, map_file_path, map_hash, progress_func, map_file,
+                                                     self.block_index(map_file))
+                if h is None:
+                    with TRACER.span('download', map_file):
+                        h = await download_to_file(url, map_file_path, map_hash, progress_func=progress_func,
+                                                   trace_key=map_file, size=self.map_size(map_file))
+            if h != map_hash:
+                self.set_map_status(i, 'download mismatch')
+                return
+            await BLOB_STORE.add(map_file_path, map_hash)
+            done_path = map_file_path
+            self.set_map_status(i, 'ok')
+        except httpx.HTTPError as e:
+            self.set_map_status(i, f'download failed: {e}')
+        finally:
+            self.downloads.pop(key).set_result(done_path)
+
+    async def process_map(self, maps_path, map_file, map_hash, i, download=True, deep=False):
+        map_file_path = maps_path / map_file
+        try:
+            size_hint = map_file_path.stat().st_size
+        except OSError:
+            size_hint = 0
+        with TRACER.span('process_map', map_file):
+            async with self.scheduler.hashing(size_hint, trace_key=map_file):
+                if map_file_path.exists():
+                    if await self.check_map_hash(map_file_path, map_hash, i) or (not download):
+                        return
+                    catalog = get_catalog(maps_path, maps=True)
+                    with TRACER.span('restore', map_file):
+                        restored = await catalog.restore(map_file_path, map_hash, deep)
+                    if restored:
+                        self.set_map_status(i, 'ok')
+                        return
+                    with TRACER.span('backup', map_file):
+                        await catalog.backup(map_file_path)
+                else:
+                    if not download:
+                        self.set_map_status(i, 'missing')
+                        return
+            await self.download_map(i, map_file, map_hash, map_file_path, self.map_size(map_file) or size_hint)
+
+    async def sync_maps(self, coj_path: Path, source_name: str, download: bool, deep=False) -> bool:
+        if self.map_source != source_name:
+            if not await self.fetch_maps(source_name):
+                return False
+        self.log_func('updating maps..' if download else 'checking maps..')
+        maps_path = get_maps_path(coj_path, self.log_func, create=download)
+        if not maps_path:
+            return False
+        applied = load_applied(maps_path) if maps_path.exists() else {}
+        added, changed, self.orphans = diff_manifests(applied, self.map_dict)
+        scheduled = set(added) | set(changed)
+        pending = {}
+        for i, (map_file, map_hash) in enumerate(self.map_dict.items()):
+            map_file_path = maps_path / map_file
+            if not deep and map_file not in scheduled and self.is_unchanged(map_file_path, map_hash):
+                self.set_map_status(i, 'ok')
+            else:
+                pending[map_file_path] = (i, map_file, map_hash)
+        try:
+            with TRACER.span('sync_maps', download=download, pending=len(pending)):
+                if download and self.bulk != 'never':
+                    await self.bulk_install(maps_path, pending)
+                async with asyncio.TaskGroup() as tg:
+                    for map_file_path in [path for path in pending if self.size_mismatch(path)]:
+                        i, map_file, map_hash = pending.pop(map_file_path)
+                        TRACER.count('size_mismatches', 1, map_file)
+                        self.set_map_status(i, 'mismatch')
+                        if download:
+                            tg.create_task(self.process_map(maps_path, map_file, map_hash, i, deep=deep))
+                    async for map_file_path, file_hash in HASH_ENGINE.hash_batch(pending, deep):
+                        i, map_file, map_hash = pending[map_file_path]
+                        if file_hash is None and not download:
+                            self.set_map_status(i, 'missing')
+                        elif file_hash is None or not await self.check_map_hash(map_file_path, map_hash, i):
+                            if download:
+                                tg.create_task(self.process_map(maps_path, map_file, map_hash, i, deep=deep))
+        finally:
+            HASH_CACHE.save(prune=True)
+            save_catalogs()
+            if maps_path.exists():
+                applied = {map_file: applied[map_file] for map_file in self.orphans}
+                applied.update({map_file: self.map_dict[map_file] for map_file, status in
+                                zip(self.map_files, self.statuses) if status in OK_STATUSES})
+                save_applied(maps_path, source_name, applied)
+        orphans_info = f' ({len(self.orphans)} orphaned maps)' if self.orphans else ''
+        self.log_func(('maps updated!' if download else 'maps checked!') + orphans_info)
+        return True
+
+    def bulk_estimate(self, maps_path: Path, needed: int) -> bool:
+        sizes = [size for map_file in self.map_files if (size := self.map_size(map_file))]
+        for map_file in self.map_files if not sizes else ():
+            try:
+                sizes.append((maps_path / map_file).stat().st_size)
+            except OSError:
+                continue
+        avg_size = sum(sizes) / len(sizes) if sizes else DEFAULT_MAP_SIZE
+        bandwidth = self.scheduler.last_throughput or DEFAULT_BANDWIDTH
+        overhead = TRACER.summary()['spans'].get('response_headers', {}).get('p50', REQUEST_OVERHEAD)
+        return prefer_bulk(needed, len(self.map_files), avg_size, bandwidth, overhead, self.scheduler.downloads)
+
+    async def bulk_install(self, maps_path: Path, pending: dict[Path, tuple[int, str, str]]):
+        wanted = {map_file: map_hash for map_file_path, (i, map_file, map_hash) in pending.items()
+                  if not map_file_path.exists() and not BLOB_STORE.has(map_hash)}
+        archive = archive_source(self.sources[self.map_source])
+        if not wanted or archive is None:
+            return
+        indices = {map_file: i for i, map_file in enumerate(self.map_files)}
+        key = ('bulk', self.map_source)
+        if key in self.downloads:
+            for map_file in wanted:
+                self.set_map_status(indices[map_file], 'waiting')
+            leader = self.downloads[key]
+            with TRACER.span('dedupe_wait', 'bulk'):
+                await asyncio.shield(leader)
+            await self.bulk_materialize(maps_path, pending, wanted, leader.result())
+            return
+        if self.bulk == 'auto' and not self.bulk_estimate(maps_path, len(wanted)):
+            return
+        for map_file in wanted:
+            self.set_map_status(indices[map_file], 'queued')
+
+        def entry_func(map_file: str, ok: bool):
+            self.set_map_status(indices[map_file], 'ok' if ok else 'download mismatch')
+
+        self.downloads[key] = asyncio.get_running_loop().create_future()
+        results = {}
+        try:
+            self.log_func(f'downloading {len(wanted)} maps as one archive..')
+            results = await bulk_download(*archive, wanted, maps_path, entry_func)
+            for map_file, ok in results.items():
+                if ok:
+                    map_file_path = maps_path / map_file
+                    HASH_CACHE.set(map_file_path, wanted[map_file])
+                    await BLOB_STORE.add(map_file_path, wanted[map_file])
+                    del pending[map_file_path]
+        finally:
+            self.downloads.pop(key).set_result({map_file: maps_path / map_file for map_file, ok in results.items()
+                                                if ok})
+        TRACER.count('bulk_maps', sum(results.values()))
+        if missing := len(wanted) - sum(results.values()):
+            self.log_func(f'{missing} maps missing or broken in the archive, downloading them one by one..')
+
+    async def bulk_materialize(self, maps_path: Path, pending: dict[Path, tuple[int, str, str]],
+                               wanted: dict[str, str], sources: dict[str, Path]):
+        indices = {map_file: i for i, map_file in enumerate(self.map_files)}
+
+        async def materialize(map_file: str):
+            map_file_path = maps_path / map_file
+            if await self.materialize(map_file, wanted[map_file], map_file_path, sources.get(map_file)):
+                self.set_map_status(indices[map_file], 'ok')
+                del pending[map_file_path]
+            else:
+                self.set_map_status(indices[map_file], 'queued')
+
+        async with asyncio.TaskGroup() as tg:
+            for map_file in wanted:
+                tg.create_task(materialize(map_file))
+
+    async def verify_changed(self, maps_path: Path, paths: set[Path]) -> list[str]:
+        indices = {map_file: i for i, map_file in enumerate(self.map_files)}
+        targets = {}
+        changed = []
+        for path in paths:
+            if path.parent == maps_path and path.name in indices:
+                HASH_CACHE.invalidate(path)
+                changed.append(path.name)
+                if self.size_mismatch(path):
+                    TRACER.count('size_mismatches', 1, path.name)
+                    self.set_map_status(indices[path.name], 'mismatch')
+                    continue
+                targets[path] = indices[path.name]
+        async for map_file_path, file_hash in HASH_ENGINE.hash_batch(targets):
+            i = targets[map_file_path]
+            if file_hash is None:
+                self.set_map_status(i, 'missing')
+            elif file_hash == self.map_dict[map_file_path.name]:
+                self.set_map_status(i, 'ok')
+            else:
+                self.set_map_status(i, 'mismatch')
+        HASH_CACHE.save_later()
+        return changed
+
+    @staticmethod
+    def is_unchanged(map_file_path: Path, map_hash: str) -> bool:
+        try:
+            return HASH_CACHE.get(map_file_path, map_file_path.stat()) == map_hash
+        except OSError:
+            return False
+
+    async def prune_orphans(self, coj_path: Path, source_name: str) -> list[str] | None:
+        if self.map_source != source_name:
+            if not await self.fetch_maps(source_name):
+                return None
+        maps_path = get_maps_path(coj_path, self.log_func)
+        if not maps_path or not maps_path.exists():
+            return None
+        applied = load_applied(maps_path)
+        orphans = [map_file for map_file in applied if map_file not in self.map_dict]
+        catalog = get_catalog(maps_path, maps=True)
+        for map_file in orphans:
+            map_file_path = maps_path / map_file
+            if map_file_path.exists():
+                await catalog.backup(map_file_path)
+            del applied[map_file]
+        save_catalogs()
+        HASH_CACHE.save()
+        save_applied(maps_path, self.map_source, applied)
+        self.orphans = []
+        self.log_func(f'pruned {len(orphans)} orphaned maps.')
+        return orphans
+
+    async def check_maps(self, coj_path: Path, source_name: str, deep=False) -> bool:
+        return await self.sync_maps(coj_path, source_name, download=False, deep=deep)
+
+    async def update_maps(self, coj_path: Path, source_name: str, deep=False) -> bool:
+        return await self.sync_maps(coj_path, source_name, download=True, deep=deep)
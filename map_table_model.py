@@ -0,0 +1,124 @@
+import time
+
+from PySide6.QtCore import QAbstractTableModel, QModelIndex, QPersistentModelIndex, Qt, QTimer, Signal
+
+HEADERS = ('map', 'status', 'size', 'progress', 'speed')
+FLUSH_INTERVAL_MS = 16
+
+
+def format_bytes(n: float) -> str:
+    for unit in ('B', 'KiB', 'MiB'):
+        if n < 1024:
+            return f'{n:.0f} {unit}' if unit == 'B' else f'{n:.1f} {unit}'
+        n /= 1024
+    return f'{n:.1f} GiB'
+
+
+class MapTableModel(QAbstractTableModel):
+    rows_changed = Signal(int, int)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.map_files: list[str] = []
+        self.statuses: list[str] = []
+        self.sizes: list[int] = []
+        self.received: list[int] = []
+        self.speeds: list[float] = []
+        self.last_progress: list[tuple[float, int]] = []
+        self.dirty_first = -1
+        self.dirty_last = -1
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(FLUSH_INTERVAL_MS)
+        self.flush_timer.timeout.connect(self.flush)
+
+    def set_maps(self, map_files: list[str]):
+        self.flush_timer.stop()
+        self.dirty_first = self.dirty_last = -1
+        self.beginResetModel()
+        n = len(map_files)
+        self.map_files = list(map_files)
+        self.statuses = [''] * n
+        self.sizes = [0] * n
+        self.received = [0] * n
+        self.speeds = [0.0] * n
+        self.last_progress = [(0.0, 0)] * n
+        self.endResetModel()
+
+    def mark_dirty(self, i: int):
+        if self.dirty_first < 0:
+            self.dirty_first = self.dirty_last = i
+        else:
+            self.dirty_first = min(self.dirty_first, i)
+            self.dirty_last = max(self.dirty_last, i)
+        if not self.flush_timer.isActive():
+            self.flush_timer.start()
+
+    def flush(self):
+        if self.dirty_first < 0:
+            return
+        first, last = self.dirty_first, self.dirty_last
+        self.dirty_first = self.dirty_last = -1
+        self.dataChanged.emit(self.index(first, 1), self.index(last, len(HEADERS) - 1))
+        self.rows_changed.emit(first, last)
+
+    def set_status(self, i: int, status: str):
+        self.statuses[i] = status
+        if status != 'downloading':
+            self.speeds[i] = 0.0
+        self.mark_dirty(i)
+
+    def set_size(self, i: int, size: int):
+        self.sizes[i] = size
+        self.mark_dirty(i)
+
+    def set_progress(self, i: int, received: int, total: int | None):
+        now = time.monotonic()
+        last_time, last_received = self.last_progress[i]
+        if last_time and now > last_time and received >= last_received:
+            speed = (received - last_received) / (now - last_time)
+            self.speeds[i] = speed if not self.speeds[i] else self.speeds[i] * 0.7 + speed * 0.3
+        self.last_progress[i] = (now, received)
+        self.received[i] = received
+        if total:
+            self.sizes[i] = total
+        self.mark_dirty(i)
+
+    def total_speed(self) -> float:
+        return sum(self.speeds)
+
+    def remaining_bytes(self, statuses: tuple[str, ...]) -> int:
+        pending = [i for i, status in enumerate(self.statuses) if status in statuses]
+        known = [size for size in self.sizes if size]
+        average_size = sum(known) // len(known) if known else 0
+        return sum(max(0, self.sizes[i] - self.received[i]) if self.sizes[i] else average_size for i in pending)
+
+    def rowCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.map_files)
+
+    def columnCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(HEADERS)
+
+    def headerData(self, section: int, orientation: Qt.Orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return HEADERS[section]
+        return super().headerData(section, orientation, role)
+
+    def data(self, index: QModelIndex | QPersistentModelIndex, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or role != Qt.ItemDataRole.DisplayRole:
+            return None
+        i = index.row()
+        column = HEADERS[index.column()]
+        if column == 'map':
+            return self.map_files[i]
+        if column == 'status':
+            return self.statuses[i]
+        if column == 'size':
+            return format_bytes(self.sizes[i]) if self.sizes[i] else ''
+        if column == 'progress':
+            if not self.received[i] or not self.sizes[i]:
+                return ''
+            return f'{min(100.0, self.received[i] * 100 / self.sizes[i]):.0f} %'
+        if column == 'speed':
+            return f'{format_bytes(self.speeds[i])}/s' if self.speeds[i] else ''
+        return None
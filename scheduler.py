@@ -0,0 +1,145 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from http_client import HTTP_CLIENT
+from tracing import TRACER
+
+THROTTLE_STATUS_CODES = (429, 503)
+
+
+class PriorityLimiter:
+    def __init__(self, limit: int, name='slot'):
+        self.limit = limit
+        self.name = name
+        self.active = 0
+        self.waiters: list[tuple[int, int, asyncio.Future]] = []
+        self.counter = itertools.count()
+
+    def set_limit(self, limit: int):
+        self.limit = max(1, limit)
+        self.wake()
+
+    def wake(self):
+        while self.active < self.limit and self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+    async def acquire(self, priority=0):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (-priority, next(self.counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.active -= 1
+        self.wake()
+
+    @asynccontextmanager
+    async def slot(self, priority=0, trace_key: str | None = None) -> AsyncIterator[None]:
+        if trace_key is None:
+            await self.acquire(priority)
+        else:
+            with TRACER.span(f'{self.name}_wait', trace_key):
+                await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class TransferScheduler:
+    def __init__(self, hash_workers=min(8, os.cpu_count() or 4), downloads=4, min_downloads=1, max_downloads=12,
+                 bandwidth_limit: int | None = None, adapt_interval=2.0):
+        self.hash_pool = PriorityLimiter(hash_workers, 'hash')
+        self.download_pool = PriorityLimiter(downloads, 'download')
+        self.min_downloads = min_downloads
+        self.max_downloads = max_downloads
+        self.bandwidth_limit = bandwidth_limit
+        self.adapt_interval = adapt_interval
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.last_throughput = 0.0
+        self.direction = 1
+        self.throttled = False
+        self.bucket_tokens = 0.0
+        self.bucket_time = time.monotonic()
+
+    def configure(self, hash_workers: int | None = None, downloads: int | None = None,
+                  max_downloads: int | None = None, bandwidth_limit: int | None = -1):
+        if hash_workers:
+            self.hash_pool.set_limit(hash_workers)
+        if max_downloads:
+            self.max_downloads = max(self.min_downloads, max_downloads)
+            self.download_pool.set_limit(min(self.download_pool.limit, self.max_downloads))
+        if downloads:
+            self.download_pool.set_limit(min(downloads, self.max_downloads))
+        if bandwidth_limit != -1:
+            self.bandwidth_limit = bandwidth_limit or None
+
+    def hashing(self, priority=0, trace_key: str | None = None):
+        return self.hash_pool.slot(priority, trace_key)
+
+    def downloading(self, priority=0, trace_key: str | None = None):
+        return self.download_pool.slot(priority, trace_key)
+
+    @property
+    def downloads(self) -> int:
+        return self.download_pool.limit
+
+    def report_status(self, status_code: int):
+        if status_code in THROTTLE_STATUS_CODES:
+            self.throttled = True
+            self.download_pool.set_limit(max(self.min_downloads, self.download_pool.limit // 2))
+
+    def adapt(self, now: float):
+        elapsed = now - self.window_start
+        if elapsed < self.adapt_interval:
+            return
+        if elapsed > self.adapt_interval * 5:
+            self.window_start = now
+            self.window_bytes = 0
+            return
+        throughput = self.window_bytes / elapsed
+        if self.throttled:
+            self.direction = -1
+        elif throughput < self.last_throughput * 0.95:
+            self.direction = -self.direction
+        limit = self.download_pool.limit
+        if not self.throttled and self.download_pool.active >= limit:
+            limit = min(self.max_downloads, max(self.min_downloads, limit + self.direction))
+            self.download_pool.set_limit(limit)
+        self.last_throughput = throughput
+        self.throttled = False
+        self.window_start = now
+        self.window_bytes = 0
+
+    async def transferred(self, n: int):
+        now = time.monotonic()
+        self.window_bytes += n
+        self.adapt(now)
+        if not self.bandwidth_limit:
+            return
+        self.bucket_tokens = min(float(self.bandwidth_limit),
+                                 self.bucket_tokens + (now - self.bucket_time) * self.bandwidth_limit)
+        self.bucket_time = now
+        self.bucket_tokens -= n
+        if self.bucket_tokens < 0:
+            await asyncio.sleep(-self.bucket_tokens / self.bandwidth_limit)
+
+
+SCHEDULER = TransferScheduler()
+HTTP_CLIENT.status_listeners.append(SCHEDULER.report_status)
@@ -0,0 +1,260 @@
+import asyncio
+import hashlib
+import os
+import time
+from collections import deque
+from pathlib import Path
+from typing import Callable
+
+import anyio
+import httpx
+
+from delta import fetch_block_index, block_length
+from hash_cache import HASH_CACHE
+from hashing import HASH_ENGINE, sha256_sync
+from http_client import HTTP_CLIENT
+from scheduler import SCHEDULER
+from tracing import TRACER
+from utils import CHUNK_SIZE, fsync_file
+
+SEGMENT_SIZE = 4 * 1024 * 1024
+SEGMENT_THRESHOLD = 16 * 1024 * 1024
+STALL_TIMEOUT = 15.0
+WORKERS_PER_MIRROR = 2
+MAX_SEGMENT_WORKERS = 8
+SLOW_MIRROR_RATIO = 0.25
+
+
+class MirrorError(Exception):
+    pass
+
+
+class MirrorStats:
+    def __init__(self):
+        self.rates: dict[str, float] = {}
+        self.failures: dict[str, int] = {}
+
+    @staticmethod
+    def key(url: str) -> str:
+        return url.rpartition('/')[0] + '/'
+
+    def record(self, url: str, n: int, seconds: float):
+        if seconds <= 0:
+            return
+        key = self.key(url)
+        rate = n / seconds
+        self.rates[key] = rate if key not in self.rates else self.rates[key] * 0.7 + rate * 0.3
+
+    def fail(self, url: str):
+        key = self.key(url)
+        self.failures[key] = self.failures.get(key, 0) + 1
+        self.rates[key] = self.rates.get(key, 0.0) / 2
+
+    def rate(self, url: str) -> float | None:
+        return self.rates.get(self.key(url))
+
+    def rank(self, urls: list[str]) -> list[str]:
+        known = [rate for url in urls if (rate := self.rate(url)) is not None]
+        default = max(known) if known else 0.0
+        return sorted(urls, key=lambda url: (self.failures.get(self.key(url), 0),
+                                             -(self.rate(url) if self.rate(url) is not None else default)))
+
+
+MIRROR_STATS = MirrorStats()
+
+
+def segment_ranges(start: int, size: int, segment_size=SEGMENT_SIZE) -> deque[tuple[int, int]]:
+    return deque((offset, min(offset + segment_size, size)) for offset in range(start, size, segment_size))
+
+
+class BlockVerifier:
+    def __init__(self, index: dict, start: int):
+        self.index = index
+        self.n = start // index['block_size']
+        self.h = hashlib.sha256()
+        self.filled = 0
+
+    def update(self, chunk) -> bool:
+        view = memoryview(chunk)
+        while view:
+            if self.n >= len(self.index['blocks']):
+                return False
+            length = block_length(self.index, self.n)
+            part = view[:length - self.filled]
+            self.h.update(part)
+            self.filled += len(part)
+            view = view[len(part):]
+            if self.filled == length:
+                if self.h.hexdigest()[:32] != self.index['blocks'][self.n][1]:
+                    return False
+                self.n += 1
+                self.h = hashlib.sha256()
+                self.filled = 0
+        return True
+
+
+def verify_written(index: dict, tmp_path: Path, start: int, end: int) -> bool:
+    verifier = BlockVerifier(index, start)
+    with tmp_path.open('rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining and (chunk := f.read(min(CHUNK_SIZE, remaining))):
+            if not verifier.update(chunk):
+                return False
+            remaining -= len(chunk)
+    return not remaining and not verifier.filled
+
+
+def write_at(fd: int, offset: int, data: bytes):
+    if hasattr(os, 'pwrite'):
+        os.pwrite(fd, data, offset)
+    else:
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, data)
+
+
+async def fetch_segment(url: str, tmp_path: Path, start: int, end: int, index: dict | None,
+                        progress_func: Callable[[int], None], trace_key: str | None) -> tuple[int, int | None]:
+    loop = asyncio.get_running_loop()
+    verifier = BlockVerifier(index, start) if index else None
+    received = 0
+    begin = time.perf_counter()
+    fd = os.open(tmp_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        async with asyncio.timeout(STALL_TIMEOUT) as timeout:
+            async with HTTP_CLIENT.stream('GET', url, headers={'Range': f'bytes={start}-{end - 1}'},
+                                          follow_redirects=True) as response:
+                response.raise_for_status()
+                total = None
+                if response.status_code == 206:
+                    content_range = response.headers.get('Content-Range', '')
+                    prefix, _, total_text = content_range.rpartition('/')
+                    if not total_text.isdigit() or prefix != f'bytes {start}-{min(end, int(total_text)) - 1}':
+                        raise MirrorError(f'unexpected Content-Range {content_range!r} from {url}')
+                    total = int(total_text)
+                    end = min(end, total)
+                elif start:
+                    raise MirrorError(f'range requests not supported by {url}')
+                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                    timeout.reschedule(loop.time() + STALL_TIMEOUT)
+                    if received + len(chunk) > end - start:
+                        raise MirrorError(f'range requests not supported by {url}')
+                    if verifier and not verifier.update(chunk):
+                        raise MirrorError(f'wrong bytes from {url}')
+                    await anyio.to_thread.run_sync(write_at, fd, start + received, chunk)
+                    received += len(chunk)
+                    TRACER.count('download_bytes', len(chunk), trace_key)
+                    progress_func(len(chunk))
+                    await SCHEDULER.transferred(len(chunk))
+    finally:
+        os.close(fd)
+    if (total is not None and received != end - start) or (verifier and verifier.filled):
+        raise MirrorError(f'short segment from {url}')
+    MIRROR_STATS.record(url, received, time.perf_counter() - begin)
+    return received, total
+
+
+async def segmented_download(urls: list[str], path: Path, expected_hash: str,
+                             progress_func: Callable[[int, int | None], None] = lambda received, total: None,
+                             trace_key: str | None = None, index: dict | None = None) -> str | None:
+    mirrors = MIRROR_STATS.rank(list(dict.fromkeys(urls)))
+    tmp_path = path.with_name(path.name + '.segments')
+    received = 0
+    size: int | None = None
+
+    def segment_progress(n: int):
+        nonlocal received
+        received += n
+        progress_func(received, size)
+
+    try:
+        tmp_path.write_bytes(b'')
+    except OSError:
+        return None
+    for mirror in list(mirrors):
+        try:
+            with TRACER.span('segment', trace_key or 'run', mirror=MIRROR_STATS.key(mirror)):
+                first, size = await fetch_segment(mirror, tmp_path, 0, SEGMENT_SIZE, None, segment_progress,
+                                                  trace_key)
+            break
+        except (httpx.HTTPError, MirrorError, TimeoutError, OSError):
+            MIRROR_STATS.fail(mirror)
+            mirrors.remove(mirror)
+            received = 0
+    else:
+        tmp_path.unlink(missing_ok=True)
+        return None
+    loop = asyncio.get_running_loop()
+    try:
+        if size is None or size <= first:
+            size = first
+        else:
+            if index is None and size >= SEGMENT_THRESHOLD:
+                index = await fetch_block_index(mirrors[0], expected_hash)
+            if index and (SEGMENT_SIZE % index['block_size'] or index['size'] != size):
+                index = None
+        with tmp_path.open('r+b') as f:
+            f.truncate(size)
+        if size > first:
+            if index and not await loop.run_in_executor(HASH_ENGINE.executor, verify_written, index, tmp_path, 0,
+                                                        first):
+                raise MirrorError(f'wrong bytes from {mirrors[0]}')
+            await download_segments(mirrors, tmp_path, size, index, segment_progress, trace_key)
+        file_hash = await loop.run_in_executor(HASH_ENGINE.executor, sha256_sync, tmp_path)
+        if file_hash != expected_hash:
+            tmp_path.unlink()
+            return None
+        async with await anyio.open_file(tmp_path, 'r+b') as f:
+            await fsync_file(f)
+        tmp_path.replace(path)
+    except (httpx.HTTPError, MirrorError, TimeoutError, OSError):
+        tmp_path.unlink(missing_ok=True)
+        return None
+    HASH_CACHE.set(path, file_hash)
+    return file_hash
+
+
+async def download_segments(mirrors: list[str], tmp_path: Path, size: int, index: dict | None,
+                            progress_func: Callable[[int], None], trace_key: str | None):
+    queue = segment_ranges(SEGMENT_SIZE, size)
+    alive = set(mirrors)
+    workers = [mirror for mirror in mirrors for _ in range(WORKERS_PER_MIRROR)][:MAX_SEGMENT_WORKERS]
+    workers = workers[:max(1, min(len(workers), len(queue)))]
+
+    def is_slow(mirror: str) -> bool:
+        rates = [rate for url in alive if (rate := MIRROR_STATS.rate(url)) is not None]
+        rate = MIRROR_STATS.rate(mirror)
+        return rate is not None and len(alive) > 1 and rate < max(rates) * SLOW_MIRROR_RATIO
+
+    async def worker(mirror: str):
+        while queue and mirror in alive:
+            if is_slow(mirror) and len(queue) < len(workers):
+                return
+            start, end = queue.popleft()
+            fetched = 0
+
+            def worker_progress(n: int):
+                nonlocal fetched
+                fetched += n
+                progress_func(n)
+
+            try:
+                with TRACER.span('segment', trace_key or 'run', mirror=MIRROR_STATS.key(mirror)):
+                    _, total = await fetch_segment(mirror, tmp_path, start, end, index, worker_progress, trace_key)
+                if total != size:
+                    raise MirrorError(f'wrong bytes from {mirror}')
+            except (httpx.HTTPError, MirrorError, TimeoutError):
+                progress_func(-fetched)
+                queue.append((start, end))
+                alive.discard(mirror)
+                MIRROR_STATS.fail(mirror)
+                TRACER.count('dropped_mirrors', 1, trace_key)
+                return
+
+    while queue and alive:
+        async with asyncio.TaskGroup() as tg:
+            for mirror in workers:
+                if mirror in alive:
+                    tg.create_task(worker(mirror))
+    if queue:
+        raise MirrorError('all mirrors failed')
@@ -1,20 +1,59 @@
+import asyncio
 import hashlib
-import json
 import zipfile
 from pathlib import Path
 from typing import Callable
 
 import httpx
 
+from app_dirs import app_cache_dir
 from constants import SERVER_LIST_MOD, SERVER_LIST_MOD_URL
-from utils import sha256_file, search_bak_and_switch, next_bak_path, download_file, write_bytes_to_file
+from backup_catalog import get_catalog, save_catalogs
+from blob_store import BLOB_STORE
+from hash_cache import HASH_CACHE
+from hashing import HASH_ENGINE
+from manifest_cache import ManifestCache
+from tracing import TRACER
+from utils import sha256_file, download_to_file, write_bytes_to_file, rename_file, CHUNK_SIZE
+
+RELEASE_CACHE = ManifestCache(app_cache_dir() / 'releases')
+ZIP_CACHE_DIR = app_cache_dir() / 'server_mod'
+
+
+def extract_member(zip_path: Path, member: str, dst: Path) -> str:
+    h = hashlib.sha256()
+    with zipfile.ZipFile(zip_path) as zip_file, zip_file.open(member) as src_f, dst.open('wb') as dst_f:
+        while chunk := src_f.read(CHUNK_SIZE):
+            h.update(chunk)
+            dst_f.write(chunk)
+    return h.hexdigest()
+
+
+def zip_matches(zip_path: Path, expected_hashes: dict[str, str]) -> bool:
+    tmp_path = zip_path.with_name(zip_path.name + '.verify')
+    try:
+        with zipfile.ZipFile(zip_path) as zip_file:
+            names = set(zip_file.namelist())
+        for file_name, file_hash in expected_hashes.items():
+            if file_name not in names or extract_member(zip_path, file_name, tmp_path) != file_hash:
+                return False
+        return True
+    except (OSError, zipfile.BadZipFile):
+        return False
+    finally:
+        tmp_path.unlink(missing_ok=True)
 
 
 class ServerModInstaller:
-    def __init__(self, coj_path: Path, log_func: Callable[[str], None]):
+    def __init__(self, coj_path: Path, log_func: Callable[[str], None], deep=False, mod_url=SERVER_LIST_MOD_URL,
+                 releases: dict[str, dict[str, str]] = SERVER_LIST_MOD):
         self.coj_path = coj_path
         self.log_func = log_func
+        self.deep = deep
+        self.mod_url = mod_url
+        self.releases = releases
         self.current_files = {}
+        self.catalog = get_catalog(coj_path)
 
     @staticmethod
     def get_custom_servers() -> list[str] | None:
@@ -25,19 +64,28 @@ class ServerModInstaller:
             return None
 
     async def check_files(self):
-        for release_tag, release in SERVER_LIST_MOD.items():
-            for file_name, file_hash in release.items():
-                if file_name in self.current_files:
-                    continue
-                file_path = self.coj_path / file_name
-                self.current_files[file_name] = (await sha256_file(file_path)) if file_path.exists() else None
+        file_names = {file_name for release in self.releases.values() for file_name in release
+                      if file_name not in self.current_files}
+        async for file_path, file_hash in HASH_ENGINE.hash_batch((self.coj_path / name for name in file_names),
+                                                                 self.deep):
+            self.current_files[file_path.name] = file_hash
+
+    async def detect_release(self, changed: set[str] | None = None) -> str | None:
+        for file_name in changed if changed is not None else list(self.current_files):
+            self.current_files.pop(file_name, None)
+            HASH_CACHE.invalidate(self.coj_path / file_name)
+        await self.check_files()
+        for release_tag, release in self.releases.items():
+            if all(self.current_files[file_name] == file_hash for file_name, file_hash in release.items()):
+                return release_tag
+        return None
 
     async def revert_to_version(self, release_tag: str, extra_success_info='') -> bool:
         failed_files = []
-        for file_name, file_hash in SERVER_LIST_MOD[release_tag].items():
+        for file_name, file_hash in self.releases[release_tag].items():
             if self.current_files[file_name] == file_hash:
                 continue
-            if await search_bak_and_switch(self.coj_path / file_name, file_hash):
+            if await self.catalog.restore(self.coj_path / file_name, file_hash, self.deep):
                 self.current_files[file_name] = file_hash
             else:
                 failed_files.append(file_name)
@@ -48,11 +96,20 @@ class ServerModInstaller:
             self.log_func(f'reverted to {release_tag}{extra_success_info}!')
             return True
 
-    async def apply(self):
-        release_tag = next(iter(SERVER_LIST_MOD))
-        await self.check_files()
+    async def apply(self) -> bool:
+        try:
+            with TRACER.span('server_mod_apply', 'server_mod'):
+                return await self.apply_release()
+        finally:
+            HASH_CACHE.save()
+            save_catalogs()
+
+    async def apply_release(self) -> bool:
+        release_tag = next(iter(self.releases))
+        with TRACER.span('check_files', 'server_mod'):
+            await self.check_files()
         file_is_missing = False
-        for file_name, file_hash in SERVER_LIST_MOD[release_tag].items():
+        for file_name, file_hash in self.releases[release_tag].items():
             current_hash = self.current_files[file_name]
             if current_hash == file_hash:
                 continue
@@ -62,63 +119,99 @@ class ServerModInstaller:
             break
         else:
             self.log_func('already patched!')
-            await self.revert_to_version('steam', ' version')
-            return
+            return await self.revert_to_version('steam', ' version')
         if not file_is_missing:
             if await self.revert_to_version(release_tag, ' (server list mod)'):
-                return
+                return True
+        zip_path = ZIP_CACHE_DIR / f'{release_tag}.zip'
+        if zip_path.exists():
+            self.log_func('installing cached server list mod..')
+            with TRACER.span('install', 'server_mod'):
+                if await self.install_from_zip(zip_path, release_tag):
+                    return True
+            zip_path.unlink(missing_ok=True)
+        if not await self.download_zip(release_tag, zip_path):
+            return False
+        with TRACER.span('install', 'server_mod'):
+            if await self.install_from_zip(zip_path, release_tag):
+                return True
+        zip_path.unlink(missing_ok=True)
+        return False
+
+    async def download_zip(self, release_tag: str, zip_path: Path) -> bool:
         self.log_func('checking latest release..')
-        async with httpx.AsyncClient() as client:
-            response = await client.get(SERVER_LIST_MOD_URL + 'releases/latest')
         try:
-            response.raise_for_status()
+            latest_release = await RELEASE_CACHE.fetch(self.mod_url + 'releases/latest')
         except httpx.HTTPError as e:
             self.log_func(str(e))
-            return
-        latest_release = json.loads(response.text)
+            return False
         latest_release_tag = latest_release['tag_name']
         if latest_release_tag != release_tag:
             self.log_func('newer server list mod available!')
         else:
             self.log_func('getting release download url..')
-        async with httpx.AsyncClient() as client:
-            response = await client.get(SERVER_LIST_MOD_URL + 'releases/tags/' + release_tag)
         try:
-            response.raise_for_status()
+            release = await RELEASE_CACHE.fetch(self.mod_url + 'releases/tags/' + release_tag)
         except httpx.HTTPError as e:
             self.log_func(str(e))
-            return
-        release = json.loads(response.text)
+            return False
         for asset in release['assets']:
             if asset['content_type'] == 'application/x-zip-compressed':
                 download_url = asset['browser_download_url']
                 break
         else:
             self.log_func('no zip found!')
-            return
+            return False
         print(latest_release_tag)
         self.log_func('downloading server list mod..')
-        buf = await download_file(download_url, follow_redirects=True)
-        with zipfile.ZipFile(buf) as zip_file:
-            for file_name, file_hash in SERVER_LIST_MOD[release_tag].items():
-                current_hash = self.current_files[file_name]
-                if current_hash == file_hash:
-                    continue
-                file = zip_file.read(file_name)
-                h = hashlib.sha256()
-                h.update(file)
-                file_hash_zip = h.hexdigest()
-                if file_hash_zip != file_hash:
-                    print(f'{file_name} hash mismatch!', file_hash_zip)
-                    self.log_func(f'{file_name} hash mismatch!')
-                    return
-                file_path = self.coj_path / file_name
-                if current_hash is not None:
-                    file_bak = next_bak_path(file_path)
-                    file_path.rename(file_bak)
-                print('writing to', file_path)
-                await write_bytes_to_file(file_path, file)
-                print(file_name, file_hash_zip)
+        ZIP_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        try:
+            with TRACER.span('download', 'server_mod'):
+                await download_to_file(download_url, zip_path, follow_redirects=True, trace_key='server_mod')
+        except httpx.HTTPError as e:
+            self.log_func(str(e))
+            return False
+        return True
+
+    async def extract_files(self, zip_path: Path, expected_hashes: dict[str, str]) -> dict[str, Path] | None:
+        loop = asyncio.get_running_loop()
+        tmp_paths = {file_name: self.coj_path / (file_name + '.extract') for file_name in expected_hashes}
+        results = await asyncio.gather(*(loop.run_in_executor(HASH_ENGINE.executor, extract_member, zip_path,
+                                                              file_name, tmp_path)
+                                         for file_name, tmp_path in tmp_paths.items()), return_exceptions=True)
+        failed = False
+        for file_name, result in zip(tmp_paths, results):
+            if isinstance(result, Exception):
+                self.log_func(f'failed to extract {file_name}: {result}')
+                failed = True
+            elif result != expected_hashes[file_name]:
+                self.log_func(f'{file_name} hash mismatch!')
+                failed = True
+            else:
+                HASH_CACHE.set(tmp_paths[file_name], result)
+        if failed:
+            for tmp_path in tmp_paths.values():
+                tmp_path.unlink(missing_ok=True)
+                HASH_CACHE.invalidate(tmp_path)
+            return None
+        return tmp_paths
+
+    async def install_from_zip(self, zip_path: Path, release_tag: str) -> bool:
+        expected_hashes = {file_name: file_hash for file_name, file_hash in self.releases[release_tag].items()
+                           if self.current_files[file_name] != file_hash}
+        tmp_paths = await self.extract_files(zip_path, expected_hashes)
+        if tmp_paths is None:
+            return False
+        for file_name, file_hash in expected_hashes.items():
+            file_path = self.coj_path / file_name
+            if self.current_files[file_name] is not None and file_path.exists():
+                await self.catalog.backup(file_path, self.current_files[file_name])
+            print('writing to', file_path)
+            rename_file(tmp_paths[file_name], file_path)
+            self.current_files[file_name] = file_hash
+            await BLOB_STORE.add(file_path, file_hash)
+            print(file_name, file_hash)
+        with zipfile.ZipFile(zip_path) as zip_file:
             serverlist = bytearray(zip_file.read('serverlist.toml'))
             custom_servers = self.get_custom_servers()
             if custom_servers:
@@ -132,11 +225,12 @@ class ServerModInstaller:
                 h = hashlib.sha256()
                 h.update(serverlist)
                 serverlist_hash = h.hexdigest()
-                if await sha256_file(serverlist_path) != serverlist_hash:
-                    if not await search_bak_and_switch(serverlist_path, serverlist_hash):
-                        serverlist_path.rename(next_bak_path(serverlist_path))
+                if await sha256_file(serverlist_path, self.deep) != serverlist_hash:
+                    if not await self.catalog.restore(serverlist_path, serverlist_hash, self.deep):
+                        await self.catalog.backup(serverlist_path)
                         await write_bytes_to_file(serverlist_path, serverlist)
             else:
                 await write_bytes_to_file(serverlist_path, serverlist)
             print(zip_file.namelist())
             self.log_func(f'patched to {release_tag} (server list mod)!')
+            return True
@@ -0,0 +1,214 @@
+import hashlib
+import io
+import json
+import random
+import tarfile
+import threading
+import time
+import zipfile
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+
+MOD_FILES = ('CoJ2_x86.dll', 'engine_x86.dll', 'serverlist.dll')
+MOD_TAG = 'release-bench'
+WRITE_CHUNK = 64 * 1024
+
+
+def sha256_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def generate_map_source(root: Path, map_count: int, map_size: int, seed: int, shared_from: Path | None = None,
+                        shared_ratio=0.5) -> dict[str, str]:
+    maps_path = root / 'maps'
+    maps_path.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    manifest = {}
+    for n in range(map_count):
+        map_file = f'bench_map_{n:04d}.pak'
+        map_path = maps_path / map_file
+        if shared_from and n < map_count * shared_ratio and (shared_from / 'maps' / map_file).exists():
+            data = (shared_from / 'maps' / map_file).read_bytes()
+        else:
+            size = max(1, int(map_size * rng.uniform(0.5, 1.5)))
+            data = rng.randbytes(size)
+        map_path.write_bytes(data)
+        manifest[map_file] = sha256_bytes(data)
+    with (root / 'manifest.json').open('w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    with tarfile.open(root / 'archive.tar.gz', 'w:gz') as tar:
+        tar.add(maps_path, arcname=f'{root.name}-main/maps')
+    return manifest
+
+
+def generate_server_mod(root: Path, seed: int) -> dict[str, dict[str, str]]:
+    rng = random.Random(seed)
+    files = {file_name: rng.randbytes(256 * 1024) for file_name in MOD_FILES}
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zip_file:
+        for file_name, data in files.items():
+            zip_file.writestr(file_name, data)
+        zip_file.writestr('serverlist.toml', 'servers = [\n    "127.0.0.1:27015",\n]\n')
+    root.mkdir(parents=True, exist_ok=True)
+    (root / 'server_list_mod.zip').write_bytes(buf.getvalue())
+    steam_files = {'CoJ2_x86.dll': files['CoJ2_x86.dll'], 'engine_x86.dll': rng.randbytes(256 * 1024)}
+    for file_name, data in steam_files.items():
+        (root / ('steam_' + file_name)).write_bytes(data)
+    return {
+        MOD_TAG: {file_name: sha256_bytes(data) for file_name, data in files.items()},
+        'steam': {file_name: sha256_bytes(data) for file_name, data in steam_files.items()},
+    }
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: 'StandInServer'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload: dict):
+        body = json.dumps(payload).encode()
+        etag = f'"{sha256_bytes(body)[:16]}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_status(self, status: int):
+        self.send_response(status)
+        self.send_header('Retry-After', '0')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.count_request()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.failure_rate and self.server.rng.random() < self.server.failure_rate:
+            self.server.count_failure()
+            self.send_error_status(503)
+            return
+        path = self.path.split('?', 1)[0]
+        if path.startswith('/repos/mod/releases/'):
+            self.send_release(path)
+            return
+        file_path = (self.server.root / path.lstrip('/')).resolve()
+        if not file_path.is_relative_to(self.server.root) or not file_path.is_file():
+            self.send_error_status(404)
+            return
+        self.send_file(file_path)
+
+    def send_release(self, path: str):
+        if path not in ('/repos/mod/releases/latest', f'/repos/mod/releases/tags/{MOD_TAG}'):
+            self.send_error_status(404)
+            return
+        host = f'http://{self.server.server_address[0]}:{self.server.server_address[1]}'
+        self.send_json({'tag_name': MOD_TAG, 'assets': [{
+            'content_type': 'application/x-zip-compressed',
+            'browser_download_url': f'{host}/mod/server_list_mod.zip',
+        }]})
+
+    def send_file(self, file_path: Path):
+        st = file_path.stat()
+        etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = 0, st.st_size - 1
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header and range_header.startswith('bytes=') and if_range in (None, etag):
+            first, _, last = range_header[6:].partition('-')
+            start = int(first) if first else max(0, st.st_size - int(last))
+            end = min(int(last), end) if first and last else end
+        if start > end and st.st_size:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{st.st_size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(206 if range_header and (start, end) != (0, st.st_size - 1) else 200)
+        if range_header:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{st.st_size}')
+        self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        with file_path.open('rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(WRITE_CHUNK, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+                self.server.count_bytes(len(chunk))
+                if self.server.bandwidth:
+                    time.sleep(len(chunk) / self.server.bandwidth)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root: Path, latency=0.0, bandwidth: int | None = None, failure_rate=0.0, seed=0,
+                 address=('127.0.0.1', 0)):
+        super().__init__(address, StandInHandler)
+        self.root = root.resolve()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.bytes_sent = 0
+        self.thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.server_address[0]}:{self.server_address[1]}/'
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def count_failure(self):
+        with self.lock:
+            self.failures += 1
+
+    def count_bytes(self, n: int):
+        with self.lock:
+            self.bytes_sent += n
+
+    def counters(self) -> dict[str, int]:
+        with self.lock:
+            return {'requests': self.requests, 'failures': self.failures, 'bytes_sent': self.bytes_sent}
+
+    def source(self, name: str) -> dict[str, str]:
+        return {'manifest': f'{self.url}{name}/manifest.json', 'maps': f'{self.url}{name}/maps/',
+                'archive': f'{self.url}{name}/archive.tar.gz', 'archive_path': 'maps/'}
+
+    @property
+    def mod_url(self) -> str:
+        return f'{self.url}repos/mod/'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
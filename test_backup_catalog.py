@@ -0,0 +1,51 @@
+import asyncio
+import hashlib
+from pathlib import Path
+
+import backup_catalog
+from backup_catalog import BackupCatalog
+
+
+def sha256_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def test_backup_with_missing_slot_keeps_file(tmp_path: Path):
+    async def run():
+        catalog = BackupCatalog(tmp_path)
+        path = tmp_path / 'a.pak'
+        path.write_bytes(b'a' * 100)
+        await catalog.backup(path)
+        (tmp_path / 'a.pak.bak').unlink()
+        path.write_bytes(b'a' * 100)
+        await catalog.backup(path)
+        return catalog
+
+    catalog = asyncio.run(run())
+    backup = catalog.files['a.pak']['backups'][sha256_bytes(b'a' * 100)]
+    assert (tmp_path / backup['slot']).read_bytes() == b'a' * 100
+
+
+def test_restore_survives_concurrent_size_cap(tmp_path: Path, monkeypatch):
+    sha256_file = backup_catalog.sha256_file
+
+    async def slow_sha256_file(path: Path, deep=False) -> str:
+        if path.name == 'a.pak.bak':
+            await asyncio.sleep(0.1)
+        return await sha256_file(path, deep)
+
+    monkeypatch.setattr(backup_catalog, 'sha256_file', slow_sha256_file)
+
+    async def run():
+        catalog = BackupCatalog(tmp_path, max_bytes=150)
+        a_path, b_path = tmp_path / 'a.pak', tmp_path / 'b.pak'
+        a_path.write_bytes(b'a' * 100)
+        await catalog.backup(a_path)
+        a_path.write_bytes(b'c' * 10)
+        b_path.write_bytes(b'b' * 100)
+        return await asyncio.gather(catalog.restore(a_path, sha256_bytes(b'a' * 100), deep=True),
+                                    catalog.backup(b_path))
+
+    restored, _ = asyncio.run(run())
+    assert restored
+    assert (tmp_path / 'a.pak').read_bytes() == b'a' * 100
@@ -0,0 +1,64 @@
+import asyncio
+import json
+from pathlib import Path
+
+import pytest
+
+import utils
+from http_client import HTTP_CLIENT
+from stand_in_server import StandInServer, generate_map_source
+from utils import download_to_file, part_path, sidecar_path
+
+
+@pytest.fixture
+def server(tmp_path: Path):
+    manifest = generate_map_source(tmp_path / 'www' / 'source', 2, 256 * 1024, seed=4)
+    server = StandInServer(tmp_path / 'www')
+    server.start()
+    yield server, manifest
+    server.stop()
+
+
+def download(url: str, path: Path, expected_hash: str) -> str:
+    async def run():
+        try:
+            return await download_to_file(url, path, expected_hash)
+        finally:
+            await HTTP_CLIENT.aclose()
+
+    return asyncio.run(run())
+
+
+def test_interrupted_after_full_body(server, tmp_path: Path, monkeypatch):
+    server, manifest = server
+    map_file, map_hash = next(iter(manifest.items()))
+    url = server.source('source')['maps'] + map_file
+    path = tmp_path / map_file
+
+    async def interrupted_fsync(f):
+        raise OSError('map is in use')
+
+    with monkeypatch.context() as m:
+        m.setattr(utils, 'fsync_file', interrupted_fsync)
+        with pytest.raises(OSError):
+            download(url, path, map_hash)
+    assert part_path(path).stat().st_size == (server.root / 'source' / 'maps' / map_file).stat().st_size
+    requests = server.counters()['requests']
+    assert download(url, path, map_hash) == map_hash
+    assert server.counters()['requests'] == requests
+    assert not part_path(path).exists() and not sidecar_path(path).exists()
+
+
+def test_range_not_satisfiable_restarts(server, tmp_path: Path):
+    server, manifest = server
+    map_file, map_hash = next(iter(manifest.items()))
+    url = server.source('source')['maps'] + map_file
+    path = tmp_path / map_file
+    data = (server.root / 'source' / 'maps' / map_file).read_bytes()
+    st = (server.root / 'source' / 'maps' / map_file).stat()
+    etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+    part_path(path).write_bytes(data + b'extra')
+    sidecar_path(path).write_text(json.dumps({'url': url, 'sha256': map_hash, 'validator': etag}))
+    assert download(url, path, map_hash) == map_hash
+    assert path.read_bytes() == data
+    assert not part_path(path).exists() and not sidecar_path(path).exists()
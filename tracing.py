@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+HTTPX_TRACE_SPANS = {
+    'connection.connect_tcp': 'connect_tcp',
+    'connection.start_tls': 'start_tls',
+    'http11.receive_response_headers': 'response_headers',
+    'http2.receive_response_headers': 'response_headers',
+}
+
+
+class Tracer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.origin = time.perf_counter()
+            self.spans: list[tuple[str, str, float, float, dict]] = []
+            self.counters: dict[str, int] = defaultdict(int)
+            self.map_counters: dict[str, dict[str, int]] = defaultdict(lambda: defaultdict(int))
+            self.lanes: dict[str, int] = {}
+
+    def add_span(self, name: str, key: str, start: float, end: float, args: dict | None = None):
+        with self.lock:
+            self.spans.append((name, key, start - self.origin, end - start, args or {}))
+
+    @contextmanager
+    def span(self, name: str, key='run', **args) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, key, start, time.perf_counter(), args)
+
+    def count(self, counter: str, n: int, key: str | None = None):
+        with self.lock:
+            self.counters[counter] += n
+            if key is not None:
+                self.map_counters[key][counter] += n
+
+    def httpx_trace(self, key: str):
+        started = {}
+
+        async def trace(event_name: str, info: dict):
+            prefix, _, state = event_name.rpartition('.')
+            if prefix not in HTTPX_TRACE_SPANS:
+                return
+            if state == 'started':
+                started[prefix] = time.perf_counter()
+            elif prefix in started:
+                self.add_span(HTTPX_TRACE_SPANS[prefix], key, started.pop(prefix), time.perf_counter())
+
+        return trace
+
+    def lane(self, key: str) -> int:
+        if key not in self.lanes:
+            self.lanes[key] = len(self.lanes)
+        return self.lanes[key]
+
+    def chrome_trace(self) -> dict:
+        with self.lock:
+            spans = list(self.spans)
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': self.lane(key),
+                   'args': {'name': key}} for key in dict.fromkeys(span[1] for span in spans)]
+        for name, key, start, duration, args in spans:
+            events.append({'name': name, 'cat': 'coj', 'ph': 'X', 'pid': os.getpid(), 'tid': self.lane(key),
+                           'ts': round(start * 1e6), 'dur': round(duration * 1e6), 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def summary(self) -> dict:
+        with self.lock:
+            spans = list(self.spans)
+            counters = dict(self.counters)
+            map_counters = {key: dict(values) for key, values in self.map_counters.items()}
+        durations = defaultdict(list)
+        for name, key, start, duration, args in spans:
+            durations[name].append(duration)
+        summary = {}
+        for name, values in durations.items():
+            values.sort()
+            summary[name] = {
+                'count': len(values),
+                'total': sum(values),
+                'p50': values[len(values) // 2],
+                'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+                'max': values[-1],
+            }
+        wall_time = max((start + duration for _, _, start, duration, _ in spans), default=0.0)
+        return {'wall_time': wall_time, 'spans': summary, 'counters': counters, 'maps': map_counters}
+
+    def prometheus(self) -> str:
+        summary = self.summary()
+        lines = ['# TYPE coj_span_seconds summary']
+        for name, values in summary['spans'].items():
+            lines.append(f'coj_span_seconds_sum{{span="{name}"}} {values["total"]:.6f}')
+            lines.append(f'coj_span_seconds_count{{span="{name}"}} {values["count"]}')
+            for quantile in ('p50', 'p95'):
+                lines.append(f'coj_span_seconds{{span="{name}",quantile="0.{quantile[1:]}"}} {values[quantile]:.6f}')
+        lines.append('# TYPE coj_counter_total counter')
+        for counter, value in summary['counters'].items():
+            lines.append(f'coj_counter_total{{counter="{counter}"}} {value}')
+        lines.append('# TYPE coj_run_wall_seconds gauge')
+        lines.append(f'coj_run_wall_seconds {summary["wall_time"]:.6f}')
+        return '\n'.join(lines) + '\n'
+
+    def write_trace(self, path: Path):
+        with path.open('w', encoding='utf-8') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def write_metrics(self, path: Path):
+        with path.open('w', encoding='utf-8') as f:
+            if path.suffix in ('.prom', '.txt'):
+                f.write(self.prometheus())
+            else:
+                json.dump(self.summary(), f, indent=1)
+
+
+TRACER = Tracer()
@@ -1,108 +1,188 @@
 import asyncio
 import hashlib
-import sys
-from io import BytesIO
+import json
+import os
 from pathlib import Path
+from typing import Callable
 
 import anyio
 import httpx
 
-from constants import LINUX_PATH, GAME_EXES, WINDOWS_REG_KEYS
+from hash_cache import HASH_CACHE
+from hashing import HASH_ENGINE
+from http_client import HTTP_CLIENT
+from scheduler import SCHEDULER
+from tracing import TRACER
 
+CHUNK_SIZE = 1024 * 1024
 
-def sha256_sync(path: Path) -> str:
-    h = hashlib.sha256()
-    with path.open('rb') as f:
-        while chunk := f.read(1024 * 1024):
-            h.update(chunk)
-    return h.hexdigest()
 
+async def sha256_file(path: Path, deep=False) -> str:
+    return await HASH_ENGINE.hash_file(path, deep)
 
-async def sha256_file(path: Path) -> str:
-    return await asyncio.to_thread(sha256_sync, path)
 
+def part_path(path: Path) -> Path:
+    return path.with_name(path.name + '.part')
 
-async def download_file(url: str, follow_redirects=False) -> BytesIO:
-    buf = BytesIO()
-    async with httpx.AsyncClient(follow_redirects=follow_redirects) as client:
-        async with client.stream('GET', url) as response:
-            response.raise_for_status()
-            async for chunk in response.aiter_bytes(1024 * 1024):
-                buf.write(chunk)
-    buf.seek(0)
-    return buf
+
+def sidecar_path(path: Path) -> Path:
+    return path.with_name(path.name + '.part.json')
+
+
+def load_partial(path: Path, url: str, expected_hash: str | None) -> dict | None:
+    tmp_path = part_path(path)
+    try:
+        with sidecar_path(path).open('r', encoding='utf-8') as f:
+            meta = json.load(f)
+        meta['received'] = tmp_path.stat().st_size
+    except (OSError, ValueError):
+        return None
+    if meta.get('url') != url or meta.get('sha256') != expected_hash or not meta['received']:
+        return None
+    if not meta.get('validator') or meta.get('preallocated'):
+        return None
+    return meta
+
+
+def write_sidecar(path: Path, meta: dict):
+    with sidecar_path(path).open('w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+
+def remove_partial(path: Path):
+    part_path(path).unlink(missing_ok=True)
+    sidecar_path(path).unlink(missing_ok=True)
 
 
-async def download_sha256(url: str, follow_redirects=False) -> tuple[BytesIO, str]:
+def range_validator(response: httpx.Response) -> str | None:
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+def sha256_partial(path: Path):
     h = hashlib.sha256()
-    buf = BytesIO()
-    async with httpx.AsyncClient(follow_redirects=follow_redirects) as client:
-        async with client.stream('GET', url) as response:
-            response.raise_for_status()
-            async for chunk in response.aiter_bytes(1024 * 1024):
-                buf.write(chunk)
-                h.update(chunk)
-    buf.seek(0)
-    return buf, h.hexdigest()
+    with path.open('rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            h.update(chunk)
+    return h
 
 
-async def write_bytesio_to_file(path: Path, buf: BytesIO, *, chunk_size=1024 * 1024):
-    view = buf.getbuffer()
-    async with await anyio.open_file(path, 'wb') as f:
-        for offset in range(0, len(view), chunk_size):
-            await f.write(view[offset:offset + chunk_size])
+def preallocate(fd: int, size: int):
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass
+    os.ftruncate(fd, size)
+
+
+def complete_partial(path: Path) -> str:
+    tmp_path = part_path(path)
+    h = sha256_partial(tmp_path)
+    with tmp_path.open('r+b') as f:
+        os.fsync(f.fileno())
+    return h.hexdigest()
 
 
-async def write_bytes_to_file(path: Path, data: bytes | bytearray, *, chunk_size=1024 * 1024):
+class PartialRejected(httpx.HTTPError):
+    pass
+
+
+async def fsync_file(f: anyio.AsyncFile):
+    await f.flush()
+    await anyio.to_thread.run_sync(os.fsync, f.wrapped.fileno())
+
+
+async def download_to_file(url: str, path: Path, expected_hash: str | None = None, follow_redirects=False,
+                           progress_func: Callable[[int, int | None], None] = lambda received, total: None,
+                           trace_key: str | None = None, size: int | None = None) -> str:
+    tmp_path = part_path(path)
+    headers = {}
+    if (meta := load_partial(path, url, expected_hash)) and meta['received'] == (meta.get('total') or size):
+        file_hash = await asyncio.get_running_loop().run_in_executor(HASH_ENGINE.executor, complete_partial, path)
+        if expected_hash is None or file_hash == expected_hash:
+            TRACER.count('resumed_bytes', meta['received'], trace_key)
+            tmp_path.replace(path)
+            sidecar_path(path).unlink(missing_ok=True)
+            HASH_CACHE.set(path, file_hash)
+            return file_hash
+        remove_partial(path)
+        meta = None
+    if meta:
+        headers = {'Range': f'bytes={meta["received"]}-', 'If-Range': meta['validator']}
+    extensions = {'trace': TRACER.httpx_trace(trace_key)} if trace_key else None
+    received = 0
+    try:
+        async with HTTP_CLIENT.stream('GET', url, headers=headers, follow_redirects=follow_redirects,
+                                      extensions=extensions) as response:
+            if meta and response.status_code == 416:
+                raise PartialRejected(f'{url} rejected the resume range')
+            response.raise_for_status()
+            if meta and response.status_code == 206:
+                if not response.headers.get('Content-Range', '').startswith(f'bytes {meta["received"]}-'):
+                    meta = None
+                    raise httpx.HTTPError(f'unexpected Content-Range for {url}')
+                received = meta['received']
+                TRACER.count('resumed_bytes', received, trace_key)
+                h = await asyncio.get_running_loop().run_in_executor(HASH_ENGINE.executor, sha256_partial,
+                                                                     tmp_path)
+            else:
+                h = hashlib.sha256()
+            content_length = response.headers.get('Content-Length')
+            total = received + int(content_length) if content_length else size
+            preallocated = not received and bool(size)
+            meta = {'url': url, 'sha256': expected_hash, 'validator': range_validator(response), 'received': received,
+                    'total': total, 'preallocated': preallocated}
+            write_sidecar(path, meta)
+            async with await anyio.open_file(tmp_path, 'ab' if received else 'wb') as f:
+                if preallocated:
+                    await anyio.to_thread.run_sync(preallocate, f.wrapped.fileno(), size)
+                with TRACER.span('transfer', trace_key or 'run'):
+                    async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                        h.update(chunk)
+                        await f.write(chunk)
+                        received += len(chunk)
+                        TRACER.count('download_bytes', len(chunk), trace_key)
+                        progress_func(received, total)
+                        await SCHEDULER.transferred(len(chunk))
+                if preallocated and received != size:
+                    await f.truncate(received)
+                file_hash = h.hexdigest()
+                if expected_hash is None or file_hash == expected_hash:
+                    with TRACER.span('fsync', trace_key or 'run'):
+                        await fsync_file(f)
+        if expected_hash is not None and file_hash != expected_hash:
+            remove_partial(path)
+            return file_hash
+        tmp_path.replace(path)
+        sidecar_path(path).unlink(missing_ok=True)
+    except PartialRejected:
+        remove_partial(path)
+        return await download_to_file(url, path, expected_hash, follow_redirects, progress_func, trace_key, size)
+    except BaseException:
+        if meta and meta.get('validator') and tmp_path.exists():
+            if meta.get('preallocated'):
+                os.truncate(tmp_path, received)
+                meta['preallocated'] = False
+            meta['received'] = tmp_path.stat().st_size
+            write_sidecar(path, meta)
+        else:
+            remove_partial(path)
+        raise
+    HASH_CACHE.set(path, file_hash)
+    return file_hash
+
+
+async def write_bytes_to_file(path: Path, data: bytes | bytearray, *, chunk_size=CHUNK_SIZE):
     view = memoryview(data)
     async with await anyio.open_file(path, 'wb') as f:
         for offset in range(0, len(view), chunk_size):
             await f.write(view[offset:offset + chunk_size])
 
 
-def next_bak_path(path):
-    base = path.with_name(path.name + '.bak')
-    if not base.exists():
-        return base
-    n = 1
-    while True:
-        candidate = base.with_name(base.name + str(n))
-        if not candidate.exists():
-            return candidate
-        n += 1
-
-
-async def search_bak_and_switch(file_path: Path, file_hash: str):
-    bak_files = list(file_path.parent.glob(file_path.name + '.bak*'))
-    for bak_file in bak_files:
-        if await sha256_file(bak_file) != file_hash:
-            continue
-        old_file = bak_file.with_name(bak_file.name + '.ren')
-        file_path.rename(old_file)
-        bak_file.rename(file_path)
-        old_file.rename(bak_file)
-        return True
-    return False
-
-
-def find_start_folder() -> Path | None:
-    if sys.platform.startswith('linux'):
-        linux_folder = Path.home() / LINUX_PATH
-        for game_exe in GAME_EXES:
-            if (linux_folder / game_exe).exists():
-                return linux_folder.resolve()
-    elif sys.platform == 'win32':
-        import winreg
-        for wow_flag in (winreg.KEY_WOW64_64KEY, winreg.KEY_WOW64_32KEY):
-            for reg_path, reg_name in WINDOWS_REG_KEYS:
-                try:
-                    with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, reg_path,
-                                        access=winreg.KEY_READ | wow_flag) as key:
-                        value, reg_type = winreg.QueryValueEx(key, reg_name)
-                except Exception:
-                    continue
-                windows_folder = Path(value)
-                for game_exe in GAME_EXES:
-                    if (windows_folder / game_exe).exists():
-                        return windows_folder.resolve()
-    return None
+def rename_file(src: Path, dst: Path):
+    src.rename(dst)
+    HASH_CACHE.move(src, dst)